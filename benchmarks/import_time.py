@@ -0,0 +1,90 @@
+"""
+Import time regression benchmark.
+
+Imports each headless module in a fresh interpreter, reports the median
+import time and fails if a module loads the GUI or takes longer than its
+budget.
+
+Usage:
+    python benchmarks/import_time.py [--repeat=<n>] [--scale=<factor>]
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Module to its import time budget in milliseconds
+BUDGETS = {
+    "witchcrafted": 50,
+    "witchcrafted.utils": 150,
+    "witchcrafted.lru": 150,
+    "witchcrafted.imagehash": 400,
+    "witchcrafted.cards.catalogue": 150,
+    "witchcrafted.cards.search": 150,
+    "witchcrafted.cards.bundle_cache": 150,
+    "witchcrafted.cards.bundle_index": 1500,
+    "witchcrafted.cards.card_data": 2000,
+    "witchcrafted.project.project_data": 2000,
+    "witchcrafted.extract": 2000,
+}
+
+# Modules no headless import may load
+GUI_MODULES = ["kivy"]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "ms": elapsed * 1000,
+    "gui": sorted(m for m in {gui!r} if m in sys.modules),
+}}))
+"""
+
+
+def measure(module):
+    """Import a module in a fresh interpreter."""
+    probe = PROBE.format(module=module, gui=GUI_MODULES)
+    result = subprocess.run(
+        [sys.executable, "-c", probe],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="multiply the budgets by this"
+    )
+    args = parser.parse_args()
+
+    failed = False
+    for (module, budget) in BUDGETS.items():
+        budget *= args.scale
+        runs = [measure(module) for _ in range(args.repeat)]
+        median = statistics.median(run["ms"] for run in runs)
+        gui = sorted({name for run in runs for name in run["gui"]})
+        status = "ok"
+        if gui:
+            status = f"FAIL loads {', '.join(gui)}"
+        elif median > budget:
+            status = f"FAIL over {budget:.0f} ms"
+        failed = failed or status != "ok"
+        print(f"{module:40} {median:8.1f} ms  {status}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,44 @@
-"""Masterduel modding tool."""
+"""
+Masterduel modding tool.
+
+Submodules are imported on first access so tools that only need the card
+data or bundle I/O don't load Kivy. The GUI lives in main, main_panel,
+dialogs and the *_view, card_panel and card_edit modules.
+"""
 __version__ = "0.1.0"
 
-from . import main, cards, utils, main_panel, dialogs, project, imagehash
+import importlib
+
+__all__ = [
+    "main",
+    "cli",
+    "cards",
+    "utils",
+    "main_panel",
+    "dialogs",
+    "project",
+    "imagehash",
+    "extract",
+    "lookup",
+    "lru",
+    "hamming",
+]
+
 
-__all__ = [main, cards, utils, main_panel, dialogs, project, imagehash]
+def __getattr__(name):
+    """Import submodules when they are first used."""
+    if name in __all__:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    """List the submodules along with the loaded attributes."""
+    return sorted(set(globals()) | set(__all__))
 
 
 def app():
     """Poetry app script's entry point."""
-    main.main({})
+    from witchcrafted import cli
+
+    cli.main()
@@ -1,9 +1,35 @@
 """
 Card view.
 
-Includes card selection and edit.
+Includes card selection and edit. Submodules are imported on first access,
+only card_view, card_panel and card_edit need Kivy.
 """
 
-from . import card_data, card_view, card_edit, card_panel
+import importlib
 
-__all__ = [card_data, card_view, card_edit, card_panel]
+__all__ = [
+    "art_index",
+    "bulk_import",
+    "bundle_cache",
+    "bundle_index",
+    "catalogue",
+    "card_data",
+    "card_view",
+    "card_edit",
+    "card_panel",
+    "load_scheduler",
+    "search",
+    "thumbnails",
+]
+
+
+def __getattr__(name):
+    """Import submodules when they are first used."""
+    if name in __all__:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    """List the submodules along with the loaded attributes."""
+    return sorted(set(globals()) | set(__all__))
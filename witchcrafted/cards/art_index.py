@@ -0,0 +1,247 @@
+"""
+Card art index.
+
+The pHash of the original art of every card, stored next to the compiled
+catalogue per source directory and searched through a multi-index hash
+table, so the cards an arbitrary picture may replace are found without
+decoding any bundle or comparing against every hash.
+
+A hash is recomputed when the bundle index entry of its card changes, that
+is when a game patch touches the bundle.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+from witchcrafted.cards.bundle_index import BundleIndex
+from witchcrafted.hamming import HammingIndex
+from witchcrafted.imagehash import perceptiveHash
+from witchcrafted.utils import cache_dir, make_logger, process_pool
+
+logger = make_logger(__name__)
+
+INDEX_VERSION = 1
+
+# How often to report progress while building, in cards
+PROGRESS_INTERVAL = 500
+
+
+def init_worker():
+    """Set up a worker process."""
+    # Only the parent process writes the indexes to disk
+    BundleIndex.flush_interval = 0
+
+
+def hash_card(card_id, bundles, source_dir):
+    """
+    Hash the art of a card in a worker process.
+
+    :return: (card_id, bundle index entry, hash) where the entry and hash
+             are None if the card has no art in the source dir
+    """
+    index = BundleIndex.for_source(source_dir)
+    texture = index.read_texture(card_id, bundles)
+    if texture is None:
+        return card_id, None, None
+    entry = index.entries.get(str(card_id), None)
+    return card_id, entry, perceptiveHash(texture.image)
+
+
+class ArtIndex:
+    """Persistent pHash index of the original card art of one source dir."""
+
+    _lock = threading.Lock()
+    _instances = {}
+
+    @classmethod
+    def for_source(cls, source_dir):
+        """Get the shared art index of a source directory."""
+        source_dir = Path(source_dir).resolve()
+        if source_dir not in cls._instances:
+            with cls._lock:
+                if source_dir not in cls._instances:
+                    cls._instances[source_dir] = cls(source_dir)
+        return cls._instances[source_dir]
+
+    def __init__(self, source_dir):
+        """Open or create the art index of a source directory."""
+        self.source_dir = Path(source_dir)
+        self.bundle_index = BundleIndex.for_source(source_dir)
+        key = hashlib.sha1(f"{self.source_dir}".encode("utf-8")).hexdigest()[:16]
+        self.index_path = cache_dir().joinpath("catalogue", f"art-{key}.json")
+        self.entries = {}
+        self._search = None
+        self._entry_lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Load the index from disk."""
+        try:
+            data = json.loads(self.index_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return
+        if (
+            data.get("version", None) != INDEX_VERSION
+            or data.get("source", None) != f"{self.source_dir}"
+        ):
+            logger.info(f"Discarding stale art index {self.index_path}")
+            return
+        self.entries = data.get("cards", {})
+
+    def flush(self):
+        """Write the index to disk."""
+        with self._entry_lock:
+            data = {
+                "version": INDEX_VERSION,
+                "source": f"{self.source_dir}",
+                "cards": dict(self.entries),
+            }
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(data), encoding="utf-8")
+        os.replace(tmp_path, self.index_path)
+
+    def update(self, card_id, bundle_entry, art_hash):
+        """Record the hash of a card's art, None if it has no art."""
+        card_id = str(card_id)
+        with self._entry_lock:
+            if bundle_entry is None or art_hash is None:
+                self.entries.pop(card_id, None)
+            else:
+                self.entries[card_id] = {
+                    "hash": art_hash,
+                    "file": bundle_entry["file"],
+                    "mtime": bundle_entry["mtime"],
+                    "size": bundle_entry["size"],
+                }
+            self._search = None
+
+    def _current(self, card_id, bundles):
+        """Get the stored hash of a card if its bundle is unchanged."""
+        entry = self.entries.get(str(card_id), None)
+        if entry is None:
+            return None
+        bundle_entry = self.bundle_index.lookup(card_id, bundles)
+        if bundle_entry is None or any(
+            bundle_entry[key] != entry[key] for key in ("file", "mtime", "size")
+        ):
+            return None
+        return entry["hash"]
+
+    def original_hash(self, card_id, bundles):
+        """
+        Get the pHash of a card's original art, hashing it if needed.
+
+        :param bundles: candidate bundle paths relative to the source dir
+        :return: the hash or None if the card has no art
+        """
+        art_hash = self._current(card_id, bundles)
+        if art_hash is not None:
+            return art_hash
+        texture = self.bundle_index.read_texture(card_id, bundles)
+        if texture is None:
+            self.update(card_id, None, None)
+            return None
+        art_hash = perceptiveHash(texture.image)
+        self.update(
+            card_id, self.bundle_index.entries.get(str(card_id), None), art_hash
+        )
+        return art_hash
+
+    def build(self, cards, jobs=None, cancelled=None):
+        """
+        Hash every card whose art is not in the index or has changed.
+
+        :param cards: list of (card_id, bundles)
+        :param jobs: number of worker processes, defaults to the CPU count
+        :param cancelled: called between cards, stops building if it is True
+        :return: number of cards hashed
+        """
+        todo = [
+            (card_id, bundles)
+            for (card_id, bundles) in cards
+            if self._current(card_id, bundles) is None
+        ]
+        if not todo:
+            return 0
+        logger.info(f"Hashing the art of {len(todo)} cards")
+        executor = process_pool(jobs or os.cpu_count(), initializer=init_worker)
+        hashed = 0
+        try:
+            futures = [
+                executor.submit(hash_card, card_id, bundles, self.source_dir)
+                for (card_id, bundles) in todo
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                if cancelled is not None and cancelled():
+                    break
+                try:
+                    card_id, bundle_entry, art_hash = future.result()
+                except Exception as e:
+                    logger.error(f"Hashing failed: {e}")
+                    continue
+                if bundle_entry is not None:
+                    self.bundle_index.update(card_id, bundle_entry)
+                self.update(card_id, bundle_entry, art_hash)
+                hashed += 1
+                if hashed % PROGRESS_INTERVAL == 0:
+                    logger.info(f"Hashed {hashed}/{len(todo)}")
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.bundle_index.flush()
+            self.flush()
+        return hashed
+
+    def search_index(self):
+        """Get the hamming search index of the hashes."""
+        search = self._search
+        if search is None:
+            with self._entry_lock:
+                search = HammingIndex(
+                    (entry["hash"], int(card_id))
+                    for (card_id, entry) in self.entries.items()
+                )
+                self._search = search
+        return search
+
+    def nearest(self, art_hash, count=5, max_distance=16):
+        """
+        Get the cards whose art is nearest to a hash.
+
+        :return: list of (distance, card_id), nearest first
+        """
+        return self.search_index().nearest(
+            art_hash, count=count, max_distance=max_distance
+        )
+
+    def duplicates(self, max_distance=0):
+        """
+        Get groups of cards with the same or nearly the same art.
+
+        :param max_distance: largest hamming distance counted as the same art
+        :return: list of lists of card IDs
+        """
+        search = self.search_index()
+        if max_distance == 0:
+            groups = search.groups()
+        else:
+            parent = {}
+
+            def find(card_id):
+                while parent.setdefault(card_id, card_id) != card_id:
+                    parent[card_id] = parent[parent[card_id]]
+                    card_id = parent[card_id]
+                return card_id
+
+            for (card_id, entry) in self.entries.items():
+                for (_, other) in search.search(entry["hash"], max_distance):
+                    parent[find(other)] = find(int(card_id))
+            members = {}
+            for card_id in parent:
+                members.setdefault(find(card_id), []).append(card_id)
+            groups = [group for group in members.values() if len(group) > 1]
+        return sorted(sorted(group) for group in groups)
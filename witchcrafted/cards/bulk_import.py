@@ -0,0 +1,205 @@
+"""
+Bulk art import.
+
+Replaces the art of many cards at once from a directory or a zip of images
+named by card ID, e.g. 4007.png. Every replacement is planned up front,
+then the images are decoded, hashed and resized in worker processes.
+Images with the same pHash as the card's current art are skipped. For
+cards without edits that is the original art, whose hash comes from the
+art index so skipping doesn't decode the game's bundle once the index is
+built.
+"""
+
+import asyncio
+import collections
+from io import BytesIO
+from pathlib import Path
+from zipfile import ZipFile
+
+import PIL.Image
+
+from witchcrafted.cards.art_index import ArtIndex
+from witchcrafted.cards.bundle_index import BundleIndex
+from witchcrafted.cards.card_data import CardData, LoadData
+from witchcrafted.imagehash import perceptiveHash
+from witchcrafted.utils import Async, make_logger
+
+logger = make_logger(__name__)
+
+IMAGE_EXTENSIONS = [".png", ".jpg", ".jpeg", ".bmp"]
+
+# Images being prepared at once, bounds the memory of an import
+PREPARE_WINDOW = 16
+
+
+def plan_import(source):
+    """
+    List the images of a directory or zip that replace card art.
+
+    Files are matched to cards by their name without extension, files
+    that don't name a card in the catalogue are ignored.
+
+    :param source: path of a directory or a zip file
+    :return: dict of card_id to the file path or zip member name
+    """
+    source = Path(source)
+    if source.is_dir():
+        names = [
+            path.relative_to(source).as_posix()
+            for path in sorted(source.rglob("*"))
+            if path.is_file()
+        ]
+    else:
+        with ZipFile(source, mode="r", allowZip64=True) as zip_ob:
+            names = sorted(zip_ob.namelist())
+
+    catalogue = LoadData.catalogue()
+    plan = {}
+    for name in names:
+        path = Path(name)
+        if path.suffix.lower() not in IMAGE_EXTENSIONS or not path.stem.isdigit():
+            continue
+        card_id = int(path.stem)
+        if card_id not in catalogue:
+            continue
+        if card_id in plan:
+            logger.warning(f"Ignoring {name}, {plan[card_id]} also replaces {card_id}")
+            continue
+        plan[card_id] = name
+    return plan
+
+
+def open_image(image_file):
+    """Open and decode an image file or the bytes of a zip member."""
+    if isinstance(image_file, bytes):
+        image_file = BytesIO(image_file)
+    image = PIL.Image.open(image_file)
+    image.load()
+    return image
+
+
+def prepare_import(card_id, bundles, source_dir, image_file, current_hash=None):
+    """
+    Decode, compare and resize an imported image in a worker process.
+
+    :param image_file: path of the image, or the bytes of a zip member read
+                       by the parent so workers don't each parse the zip
+    :param current_hash: pHash of the card's edited image if it has one,
+                         compared instead of the original art's
+    :return: dict with the card_id, the bundle index entry and original
+             art hash for the parent's indexes, and the image to set or
+             None if the card has no art or the image is its current art
+    """
+    BundleIndex.flush_interval = 0
+    index = BundleIndex.for_source(source_dir)
+    art_index = ArtIndex.for_source(source_dir)
+    result = {"card_id": card_id, "image": None}
+    result["original_hash"] = art_index.original_hash(card_id, bundles)
+    entry = result["entry"] = index.entries.get(str(card_id), None)
+    if entry is None or result["original_hash"] is None:
+        return result
+
+    if current_hash is None:
+        current_hash = result["original_hash"]
+    image = open_image(image_file)
+    if perceptiveHash(image) == current_hash:
+        return result
+    size = (entry["width"], entry["height"])
+    if image.size != size:
+        image = image.resize(size, PIL.Image.BICUBIC)
+    result["image"] = image
+    return result
+
+
+async def bulk_import(source, source_dir=None, progress=None, cancelled=None):
+    """
+    Replace the art of every card with an image in a directory or zip.
+
+    :param source: path of a directory or a zip file of images named by
+                   card ID
+    :param progress: called with (done, total) as images are processed
+    :param cancelled: called between images, stops importing if it is
+                      True, images already imported are kept
+    :return: (imported, unchanged, failed) counts
+    """
+    asc = Async()
+    if source_dir is None:
+        source_dir = LoadData.source_dir()
+    catalogue = LoadData.catalogue()
+    plan = await asc.async_thread(lambda: plan_import(source))
+    total = len(plan)
+    logger.info(f"Importing {total} images from {source}")
+
+    index = BundleIndex.for_source(source_dir)
+    art_index = ArtIndex.for_source(source_dir)
+    imported = unchanged = failed = done = 0
+    pending = collections.deque()
+    archive = None
+
+    async def edited_hash(card_id):
+        card_data = CardData(card_id)
+        if not card_data.edited("image"):
+            return None
+        image = await card_data.get_image()
+        return await asc.async_thread(lambda: perceptiveHash(image))
+
+    async def prepare(card_id, name, bundles, current_hash):
+        if archive is None:
+            image_file = Path(source).joinpath(name)
+        else:
+            image_file = await asc.async_thread(lambda: archive.read(name))
+        return await asc.async_process(
+            prepare_import, card_id, bundles, source_dir, image_file, current_hash
+        )
+
+    async def finish(card_id, prepared):
+        nonlocal imported, unchanged, failed, done
+        try:
+            result = await prepared
+        except Exception as e:
+            failed += 1
+            logger.error(f"Failed to import {plan[card_id]}: {e}")
+        else:
+            if result["entry"] is not None:
+                index.update(card_id, result["entry"])
+                art_index.update(card_id, result["entry"], result["original_hash"])
+            if result["entry"] is None:
+                failed += 1
+                logger.warning(f"No art found for {card_id}, skipping")
+            elif result["image"] is None:
+                unchanged += 1
+            else:
+                await CardData(card_id).replace_image(result["image"])
+                imported += 1
+        done += 1
+        if progress is not None:
+            progress(done, total)
+
+    try:
+        if not Path(source).is_dir():
+            archive = await asc.async_thread(
+                lambda: ZipFile(source, mode="r", allowZip64=True)
+            )
+        for (card_id, name) in plan.items():
+            if cancelled is not None and cancelled():
+                break
+            bundles = LoadData.bundle_candidates(catalogue[card_id])
+            current_hash = await edited_hash(card_id)
+            prepared = asyncio.ensure_future(
+                prepare(card_id, name, bundles, current_hash)
+            )
+            pending.append((card_id, prepared))
+            if len(pending) >= PREPARE_WINDOW:
+                await finish(*pending.popleft())
+        while pending and not (cancelled is not None and cancelled()):
+            await finish(*pending.popleft())
+    finally:
+        for (_, prepared) in pending:
+            prepared.cancel()
+        if archive is not None:
+            archive.close()
+        await asc.async_thread(index.flush)
+        await asc.async_thread(art_index.flush)
+
+    logger.info(f"Imported {imported}, unchanged {unchanged}, failed {failed}")
+    return imported, unchanged, failed
@@ -0,0 +1,220 @@
+"""
+Loaded bundle cache.
+
+Parsing a bundle with UnityPy decompresses all of it, so the parsed
+environments are kept in an LRU shared by reading card art and committing
+edits. Viewing a card and then exporting or committing it, or opening
+several cards of one bundle, parses the bundle once.
+
+Entries are keyed by bundle path, mtime and size so a bundle changed on
+disk is parsed again. UnityPy environments are not thread safe, every
+entry has its own lock held while it is used.
+"""
+
+import contextlib
+import mmap
+import os
+import threading
+from pathlib import Path
+
+from witchcrafted.lru import LruCache
+from witchcrafted.utils import make_logger
+
+logger = make_logger(__name__)
+
+
+def environment_nbytes(env, default=0):
+    """Estimate the memory held by a loaded environment."""
+
+    def nbytes(item):
+        reader = getattr(item, "reader", item)
+        length = getattr(reader, "Length", None)
+        if isinstance(length, int):
+            return length
+        return sum(nbytes(child) for child in getattr(item, "files", {}).values())
+
+    return nbytes(getattr(env, "file", env)) or default
+
+
+def load_environment(path):
+    """
+    Parse a bundle read through a memory map.
+
+    The bundle's blocks are read from the page cache instead of being
+    copied onto the heap first. The map is closed once UnityPy holds no
+    views of it, which is after parsing for bundles as their blocks are
+    decompressed into new buffers.
+    """
+    import UnityPy
+    from UnityPy.enums import FileType
+    from UnityPy.helpers import ImportHelper
+    from UnityPy.streams import EndianBinaryReader
+
+    path = f"{path}"
+    with open(path, "rb") as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Empty or unmappable file
+            return UnityPy.load(path)
+    view = memoryview(mapped)
+    reader = EndianBinaryReader(view)
+    # Named, UnityPy would otherwise name it by hashing all of its bytes
+    reader.name = os.path.basename(path)
+    typ, _ = ImportHelper.check_file_type(reader)
+    env = None
+    if typ in (FileType.BundleFile, FileType.AssetsFile, FileType.WebFile):
+        env = UnityPy.Environment()
+        env.path = os.path.dirname(path)
+        try:
+            env.file = env.files[reader.name] = env.load_file(reader)
+        except AttributeError:
+            # UnityPy failed to parse it and could not wrap the reader
+            # again as a plain resource
+            env = None
+    del reader
+    view.release()
+    with contextlib.suppress(BufferError):
+        # Fails while parsed files still reference it, in which case it is
+        # unmapped once they are collected
+        mapped.close()
+    if env is None:
+        # Not a bundle, left to UnityPy as is
+        return UnityPy.load(path)
+    return env
+
+
+class _Entry:
+    """A loaded environment and the lock of whoever uses it."""
+
+    __slots__ = ("env", "lock")
+
+    def __init__(self, env):
+        """Wrap a loaded environment."""
+        self.env = env
+        self.lock = threading.Lock()
+
+
+class BundleCache:
+    """LRU of parsed bundles bounded by count and memory."""
+
+    _lock = threading.Lock()
+    _instance = None
+
+    @classmethod
+    def shared(cls):
+        """Get the cache shared by the read and write paths."""
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, max_items=8, max_bytes=256 * 1024 * 1024, loader=None):
+        """
+        Create the cache.
+
+        :param loader: function parsing the bundle at a path
+        """
+        self._cache = LruCache(max_bytes=max_bytes, max_items=max_items)
+        self.loader = loader if loader is not None else load_environment
+        # One lock per key so a bundle is parsed once even when many
+        # threads ask for it at the same time
+        self._load_locks = {}
+        self._load_lock = threading.Lock()
+        self.requests = 0
+        self.loads = 0
+
+    @staticmethod
+    def key(path):
+        """Get the cache key of a bundle, None if it is missing."""
+        path = Path(path)
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        return (f"{path.resolve()}", stat.st_mtime_ns, stat.st_size)
+
+    def _entry(self, key):
+        """Get the entry of a key, parsing the bundle if needed."""
+        entry = self._cache.get(key, None)
+        if entry is not None:
+            return entry
+        with self._load_lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        loaded = False
+        with load_lock:
+            entry = self._cache.get(key, None)
+            if entry is None:
+                env = self.loader(key[0])
+                entry = _Entry(env)
+                self._cache.put(key, entry, size=environment_nbytes(env, key[2]))
+                loaded = True
+        with self._load_lock:
+            self._load_locks.pop(key, None)
+            self.loads += loaded
+        return entry
+
+    @contextlib.contextmanager
+    def open(self, path):
+        """
+        Use the parsed environment of a bundle.
+
+        The environment is only safe to use inside the with block and must
+        not be modified, use take to edit it.
+        """
+        key = self.key(path)
+        if key is None:
+            raise FileNotFoundError(f"{path}")
+        with self._load_lock:
+            self.requests += 1
+        while True:
+            entry = self._entry(key)
+            with entry.lock:
+                # None if a writer took it meanwhile
+                if entry.env is not None:
+                    yield entry.env
+                    return
+
+    def take(self, path):
+        """
+        Remove the parsed environment of a bundle from the cache.
+
+        For writers, the environment is parsed if it was not cached and
+        the caller owns it.
+        """
+        key = self.key(path)
+        if key is None:
+            raise FileNotFoundError(f"{path}")
+        entry = self._cache.pop(key, None)
+        if entry is not None:
+            # Wait for readers to finish with it
+            with entry.lock:
+                (env, entry.env) = (entry.env, None)
+        else:
+            env = None
+        with self._load_lock:
+            self.requests += 1
+            if env is None:
+                self.loads += 1
+        if env is None:
+            env = self.loader(key[0])
+        return env
+
+    def clear(self):
+        """Forget every parsed bundle."""
+        self._cache.clear()
+
+    def stats(self):
+        """Get how often a bundle was parsed again and the cache memory."""
+        requests = self.requests
+        loads = self.loads
+        stats = self._cache.stats()
+        return {
+            "requests": requests,
+            "loads": loads,
+            "hit_rate": (requests - loads) / requests if requests else 0.0,
+            "evictions": stats["evictions"],
+            "items": stats["items"],
+            "bytes": stats["bytes"],
+        }
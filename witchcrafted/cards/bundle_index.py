@@ -0,0 +1,214 @@
+"""
+Card bundle index.
+
+Remembers which bundle file and object holds the art of each card so that
+opening a card is a single stat and one object read instead of probing
+both TCG and OCG paths and scanning every object in the bundle.
+
+The index is stored on disk per source directory and an entry is
+rescanned whenever the size or mtime of its bundle changes.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+from witchcrafted.cards.bundle_cache import BundleCache
+from witchcrafted.utils import cache_dir, make_logger
+
+logger = make_logger(__name__)
+
+INDEX_VERSION = 1
+
+
+def find_object(item, path_id):
+    """Find an object by path id in a loaded environment or bundle."""
+    from UnityPy.files import SerializedFile
+
+    if isinstance(item, SerializedFile):
+        return item.objects.get(path_id, None)
+    for child in getattr(item, "files", {}).values():
+        obj = find_object(child, path_id)
+        if obj is not None:
+            return obj
+    return None
+
+
+class BundleIndex:
+    """Persistent card ID to bundle object index for one source directory."""
+
+    _lock = threading.Lock()
+    _instances = {}
+
+    # Number of new entries before the index is written back to disk,
+    # 0 leaves writing to whoever owns the index (e.g. worker processes)
+    flush_interval = 32
+
+    @classmethod
+    def for_source(cls, source_dir):
+        """Get the shared index of a source directory."""
+        source_dir = Path(source_dir).resolve()
+        if source_dir not in cls._instances:
+            with cls._lock:
+                if source_dir not in cls._instances:
+                    cls._instances[source_dir] = cls(source_dir)
+        return cls._instances[source_dir]
+
+    @classmethod
+    def flush_all(cls):
+        """Write every modified index to disk."""
+        with cls._lock:
+            instances = list(cls._instances.values())
+        for index in instances:
+            index.flush()
+
+    def __init__(self, source_dir):
+        """Open or create the index of a source directory."""
+        self.source_dir = Path(source_dir)
+        key = hashlib.sha1(f"{self.source_dir}".encode("utf-8")).hexdigest()[:16]
+        self.index_path = cache_dir().joinpath("bundle_index", f"{key}.json")
+        self.entries = {}
+        self._pending = 0
+        self._entry_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Load the index from disk."""
+        try:
+            data = json.loads(self.index_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return
+        if (
+            data.get("version", None) != INDEX_VERSION
+            or data.get("source", None) != f"{self.source_dir}"
+        ):
+            logger.info(f"Discarding stale bundle index {self.index_path}")
+            return
+        self.entries = data.get("cards", {})
+
+    def flush(self):
+        """Write the index to disk if it changed."""
+        with self._flush_lock:
+            with self._entry_lock:
+                if not self._pending:
+                    return
+                data = {
+                    "version": INDEX_VERSION,
+                    "source": f"{self.source_dir}",
+                    "cards": dict(self.entries),
+                }
+                self._pending = 0
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.index_path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(data), encoding="utf-8")
+            os.replace(tmp_path, self.index_path)
+
+    def _store(self, card_id, entry):
+        """Record an entry and flush once enough have accumulated."""
+        with self._entry_lock:
+            if entry is None:
+                self.entries.pop(card_id, None)
+            else:
+                self.entries[card_id] = entry
+            self._pending += 1
+            flush = self.flush_interval and self._pending >= self.flush_interval
+        if flush:
+            self.flush()
+
+    def update(self, card_id, entry):
+        """Record an entry found elsewhere, such as in a worker process."""
+        card_id = str(card_id)
+        if entry != self.entries.get(card_id, None):
+            self._store(card_id, entry)
+
+    def _valid(self, entry):
+        """Check an entry against the current state of its bundle."""
+        try:
+            stat = self.source_dir.joinpath(entry["file"]).stat()
+        except OSError:
+            return False
+        return stat.st_mtime_ns == entry["mtime"] and stat.st_size == entry["size"]
+
+    def cached(self, card_id):
+        """Get the entry of a card if it is indexed and valid, without scanning."""
+        entry = self.entries.get(str(card_id), None)
+        if entry is not None and self._valid(entry):
+            return entry
+        return None
+
+    def _scan(self, card_id, bundle):
+        """Scan a bundle for the texture of a card, returning entry and texture."""
+        file_path = self.source_dir.joinpath(bundle)
+        try:
+            stat = file_path.stat()
+        except OSError:
+            return None, None
+        with BundleCache.shared().open(file_path) as env:
+            for obj in env.objects:
+                if obj.type.name in ["Texture2D"]:
+                    path = obj.container
+                    data = None
+                    if path is None:
+                        data = obj.read()
+                        path = data.name
+                    if Path(path).stem == card_id:
+                        if data is None:
+                            data = obj.read()
+                        entry = {
+                            "file": Path(bundle).as_posix(),
+                            "path_id": obj.path_id,
+                            "format": data.m_TextureFormat.name,
+                            "width": data.m_Width,
+                            "height": data.m_Height,
+                            "mtime": stat.st_mtime_ns,
+                            "size": stat.st_size,
+                        }
+                        return entry, data
+        return None, None
+
+    def _resolve(self, card_id, bundles):
+        """Get the entry of a card and the texture if a scan was needed."""
+        card_id = str(card_id)
+        entry = self.entries.get(card_id, None)
+        if entry is not None and self._valid(entry):
+            return entry, None
+        for bundle in bundles:
+            found, data = self._scan(card_id, bundle)
+            if found is not None:
+                self._store(card_id, found)
+                return found, data
+        if entry is not None:
+            self._store(card_id, None)
+        return None, None
+
+    def lookup(self, card_id, bundles):
+        """
+        Get the index entry of a card.
+
+        :param card_id: The card to find
+        :param bundles: Candidate bundle paths relative to the source dir,
+                        in order of preference
+        :return: The entry dict or None if the card has no art
+        """
+        entry, _ = self._resolve(card_id, bundles)
+        return entry
+
+    def bundle_path(self, entry):
+        """Get the absolute bundle path of an entry."""
+        return self.source_dir.joinpath(entry["file"])
+
+    def read_texture(self, card_id, bundles):
+        """Read the Texture2D of a card with a single object read."""
+        entry, data = self._resolve(card_id, bundles)
+        if entry is None or data is not None:
+            return data
+        with BundleCache.shared().open(self.bundle_path(entry)) as env:
+            obj = find_object(env, entry["path_id"])
+            if obj is not None and obj.type.name in ["Texture2D"]:
+                return obj.read()
+        # Bundle replaced in place without a size or mtime change
+        self._store(str(card_id), None)
+        return None
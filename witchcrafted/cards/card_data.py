@@ -1,22 +1,33 @@
 """
 Card data.
 
-This is loaded from database or from the game files.
+This is loaded from database or from the game files. Kivy is only imported
+when a texture is made or the app config is read, so this can be used
+without the GUI.
 """
 
-import UnityPy
+from multiprocessing import shared_memory
+import contextlib
+import os
 from pathlib import Path
-import pandas as pd
 import threading
 import asyncio
-import PIL
-import io
-
-from kivy.app import App
-from kivy.core.image import Image as CoreImage
+import weakref
+import PIL.Image
 
 from witchcrafted.utils import Async, data_dir
-from witchcrafted.imagehash import perceptiveHash
+from witchcrafted.lru import LruCache
+from witchcrafted.imagehash import perceptiveHashes
+from witchcrafted.cards.bundle_cache import BundleCache
+from witchcrafted.cards.bundle_index import BundleIndex
+from witchcrafted.cards.catalogue import MAIN_FOLDER, CardCatalogue
+from witchcrafted.cards.thumbnails import ThumbnailCache, make_thumbnail
+
+
+_missing = object()
+
+# Seconds before unmapping shared memory is tried again without a loop
+RELEASE_RETRY = 0.05
 
 
 class LoadData:
@@ -24,145 +35,354 @@ class LoadData:
 
     _lock = threading.Lock()
 
-    __df = None
-    __df_common = None
+    __catalogue = None
 
     @classmethod
-    def cards_data(cls):
-        """Get pandas data on all cards."""
-        if cls.__df is None:
+    def catalogue(cls):
+        """Get the card catalogue indexed by card ID."""
+        if cls.__catalogue is None:
             with cls._lock:
-                if cls.__df is None:
-                    cls.__df = pd.read_csv(
+                if cls.__catalogue is None:
+                    cls.__catalogue = CardCatalogue.load(
                         data_dir().joinpath("assets", "card_list.csv")
                     )
-        return cls.__df
-
-    @classmethod
-    def main_cards_data(cls):
-        """Get pandas data on the cards in the 0000 folder."""
-        if cls.__df_common is None:
-            df = cls.cards_data()
-            card_list = df[(df["Folder Name"] == "0000")]
-            card_list.reset_index(inplace=True)
-            with cls._lock:
-                if cls.__df_common is None:
-                    cls.__df_common = card_list
-        return cls.__df_common
+        return cls.__catalogue
 
     @classmethod
     def main_cards_ids(cls):
-        """Get card IDs."""
-        df = cls.main_cards_data()
-        return df[["Card ID"]]
+        """Get the IDs of the cards in the 0000 folder."""
+        return cls.catalogue().folder_ids(MAIN_FOLDER)
 
     @classmethod
-    def image(cls, card_id):
-        """Load an image using pandas data and a card id."""
-        df = cls.cards_data()
+    def source_dir(cls):
+        """Get the source dir from the app config."""
+        from kivy.app import App
+
         app = App.get_running_app()
-        root_dir = Path(app.config.get("paths", "source"))
+        return Path(app.config.get("paths", "source"))
 
-        card_data = df.loc[df["Card ID"] == card_id].iloc[0].to_dict()
+    @classmethod
+    def bundle_candidates(cls, card_data):
+        """Get the bundle paths of a card relative to the source dir."""
         top_level_folder = card_data["Folder Name"]
-        tcg_file_name = card_data["File, TCG"]
-        ocg_file_name = card_data["File, OCG"]
+        file_names = dict.fromkeys((card_data["File, TCG"], card_data["File, OCG"]))
+        return [
+            Path(top_level_folder, file_name[0:2], file_name)
+            for file_name in file_names
+        ]
 
-        tcg_file_prefix = tcg_file_name[0:2]
-        file_path_tcg = root_dir.joinpath(
-            top_level_folder, tcg_file_prefix, tcg_file_name
-        )
+    @classmethod
+    def image(cls, card_id, source_dir=None):
+        """Load an image using the catalogue and a card id."""
+        if source_dir is None:
+            source_dir = cls.source_dir()
+
+        card_data = cls.catalogue()[card_id]
+        index = BundleIndex.for_source(source_dir)
+        texture = index.read_texture(card_id, cls.bundle_candidates(card_data))
+        if texture is None:
+            return None
+        return texture.image
+
+    @classmethod
+    async def image_in_process(cls, card_id, source_dir=None):
+        """
+        Load an image with the texture decoded in a worker process.
+
+        The pixels come back through shared memory and are used by the
+        image without a copy.
+        """
+        asc = Async()
+        if source_dir is None:
+            source_dir = cls.source_dir()
+
+        bundles = cls.bundle_candidates(cls.catalogue()[card_id])
+        index = BundleIndex.for_source(source_dir)
+        # Only size the block here if that needs no scan, the worker
+        # creates one from the texture it reads otherwise
+        entry = await asc.async_thread(lambda: index.cached(card_id))
+        shm = None
+        if entry is not None:
+            shm = shared_memory.SharedMemory(
+                create=True, size=entry["width"] * entry["height"] * 4
+            )
+        name = None if shm is None else shm.name
+        try:
+            (entry, mode, size, name, pixels) = await asc.async_process(
+                decode_shared, card_id, bundles, source_dir, name
+            )
+        except BaseException:
+            if shm is not None:
+                shm.close()
+            raise
+        finally:
+            if shm is not None:
+                # The mapping outlives the name
+                shm.unlink()
+        if shm is not None and name != shm.name:
+            shm.close()
+            shm = None
+        if shm is None and name is not None:
+            shm = shared_memory.SharedMemory(name=name)
+            shm.unlink()
+        index.update(card_id, entry)
+        if entry is None:
+            return None
+        if shm is None:
+            return PIL.Image.frombytes(mode, size, pixels)
+        return shared_image(shm, mode, size)
 
-        ocg_file_prefix = ocg_file_name[0:2]
-        file_path_ocg = root_dir.joinpath(
-            top_level_folder, ocg_file_prefix, ocg_file_name
+    @classmethod
+    def thumbnail(cls, card_id, size, source_dir=None):
+        """Get the path of a card's thumbnail, generating it if needed."""
+        if source_dir is None:
+            source_dir = cls.source_dir()
+
+        card_data = cls.catalogue()[card_id]
+        thumbnails = ThumbnailCache.for_source(source_dir)
+        return thumbnails.load(card_id, cls.bundle_candidates(card_data), size)
+
+    @classmethod
+    async def thumbnail_in_process(cls, card_id, size, source_dir=None):
+        """Get the path of a card's thumbnail, generating it in a worker process."""
+        asc = Async()
+        if source_dir is None:
+            source_dir = cls.source_dir()
+
+        bundles = cls.bundle_candidates(cls.catalogue()[card_id])
+        thumbnails = ThumbnailCache.for_source(source_dir)
+        path = await asc.async_thread(
+            lambda: thumbnails.existing(card_id, bundles, size)
+        )
+        if path is not None:
+            return path
+        (path, entry) = await asc.async_process(
+            make_thumbnail, card_id, bundles, size, source_dir
         )
+        thumbnails.index.update(card_id, entry)
+        return path
 
-        if file_path_tcg.exists():
-            file_path = file_path_tcg
-        elif file_path_ocg.exists():
-            file_path = file_path_ocg
-        else:
-            return
+    @classmethod
+    def warm_thumbnails(cls, card_ids, size, source_dir=None, cancelled=None):
+        """Generate the missing thumbnails of many cards."""
+        catalogue = cls.catalogue()
+        if source_dir is None:
+            source_dir = cls.source_dir()
+
+        cards = [
+            (card_id, cls.bundle_candidates(catalogue[card_id])) for card_id in card_ids
+        ]
+        thumbnails = ThumbnailCache.for_source(source_dir)
+        thumbnails.warm(cards, size, cancelled=cancelled)
+
+    @classmethod
+    def output_dir(cls):
+        """Get the output dir from the app config."""
+        from kivy.app import App
 
-        env = UnityPy.load(f"{file_path}")
+        app = App.get_running_app()
+        return Path(app.config.get("paths", "output"))
+
+    @classmethod
+    def plan_commit(cls, images, source_dir=None):
+        """
+        Group edited images by the source bundles they must be written to.
+
+        :param images: dict of card_id to the edited image
+        :return: dict of bundle path, relative to the source dir, to a dict
+                 of card_id to image for every texture to replace in it
+        """
+        catalogue = cls.catalogue()
+        if source_dir is None:
+            source_dir = cls.source_dir()
+
+        plan = {}
+        for (card_id, image) in images.items():
+            card_data = catalogue[card_id]
+            for bundle in cls.bundle_candidates(card_data):
+                if source_dir.joinpath(bundle).is_file():
+                    plan.setdefault(bundle, {})[card_id] = image
+        return plan
+
+    @classmethod
+    def save_bundle(cls, source, dest, images):
+        """
+        Replace every edited texture of a bundle and write it once.
+
+        :param source: the bundle to read
+        :param dest: where to write the edited bundle
+        :param images: dict of card_id to the image to put in the bundle
+        """
+        remaining = {str(card_id): image for (card_id, image) in images.items()}
+        # Edits change the environment, take it out of the cache
+        env = BundleCache.shared().take(source)
+        changed = False
         for obj in env.objects:
             if obj.type.name in ["Texture2D"]:
-                data = obj.read()
                 path = obj.container
+                data = None
                 if path is None:
+                    data = obj.read()
                     path = data.name
                 resouce_name = Path(path).stem
-                card_id = str(card_id)
-                if resouce_name == card_id:
-                    return data.image
+                if resouce_name in remaining:
+                    if data is None:
+                        data = obj.read()
+                    data.image = remaining.pop(resouce_name).convert("RGBA")
+                    data.save()
+                    changed = True
+                    if not remaining:
+                        break
+        if changed:
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            dest.write_bytes(env.file.save())
+
+
+def image_nbytes(image):
+    """Estimate the memory held by a PIL image or a texture."""
+    if image is None:
+        return 0
+    width, height = image.size
+    if isinstance(image, PIL.Image.Image):
+        return width * height * len(image.getbands())
+    return width * height * 4
+
+
+def rgba_buffer(image):
+    """
+    Get the RGBA pixels of a PIL image for a texture upload.
+
+    Run this off the UI loop, it is the costly half of showing an image.
+
+    :return: (size, pixel bytes)
+    """
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    return image.size, image.tobytes()
+
+
+def read_thumbnail(path):
+    """Read a thumbnail PNG for a texture upload."""
+    with PIL.Image.open(path) as image:
+        return rgba_buffer(image)
+
+
+def fit_image(old_image, image):
+    """
+    Prepare an image to replace another.
+
+    Run this off the UI loop, it hashes both images and resizes.
+
+    :return: the image at the old image's size or None if the images have
+             the same pHash
+    """
+    old_hash, new_hash = perceptiveHashes([old_image, image])
+    if old_hash == new_hash:
         return None
+    if old_image.size != image.size:
+        image = image.resize(old_image.size, PIL.Image.BICUBIC)
+    return image
+
+
+def decode_shared(card_id, bundles, source_dir, name=None):
+    """
+    Decode the art of a card in a worker process into shared memory.
+
+    :param name: shared memory block sized for 4 bytes per pixel of the
+                 card's bundle index entry, None to create one. A given
+                 block is only attached to by name.
+    :return: (bundle index entry, mode, size, block name, None) with the
+             pixels in the named block. The worker never unlinks a block,
+             the caller does whether it or the worker made it. On
+             Windows a block is gone once the worker closes it, so the
+             pixel bytes come back instead of a block name if none or a
+             too small one was given. The entry is None if the card has
+             no art.
+    """
+    BundleIndex.flush_interval = 0
+    index = BundleIndex.for_source(source_dir)
+    texture = index.read_texture(card_id, bundles)
+    if texture is None:
+        return None, None, None, None, None
+    entry = index.entries.get(str(card_id), None)
+    image = texture.image
+    pixels = image.tobytes()
+    shm = None
+    if name is not None:
+        shm = shared_memory.SharedMemory(name=name)
+        if len(pixels) > shm.size:
+            # The bundle changed since the block was sized
+            shm.close()
+            shm = None
+    if shm is None:
+        if os.name == "nt":
+            return entry, image.mode, image.size, None, pixels
+        shm = shared_memory.SharedMemory(create=True, size=len(pixels))
+    try:
+        shm.buf[: len(pixels)] = pixels
+    finally:
+        shm.close()
+    return entry, image.mode, image.size, shm.name, None
+
+
+def shared_image(shm, mode, size):
+    """Wrap pixels in shared memory in an image without copying them."""
+    image = PIL.Image.frombuffer(mode, size, shm.buf, "raw", mode, 0, 1)
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    weakref.finalize(image, release_shared, shm, loop)
+    return image
+
+
+def release_shared(shm, loop=None):
+    """Unmap shared memory once the image using it is gone."""
+    try:
+        shm.close()
+        return
+    except BufferError:
+        # Called while the image is collected and still holds the pixels
+        pass
+    if loop is not None and loop.is_running():
+        with contextlib.suppress(RuntimeError):
+            # Unless the loop was closed meanwhile
+            loop.call_soon_threadsafe(release_shared, shm, loop)
+            return
+    timer = threading.Timer(RELEASE_RETRY, release_shared, (shm,))
+    timer.daemon = True
+    timer.start()
 
-    @classmethod
-    def save_image(cls, card_id, image, project_name):
-        """Save an image using pandas data and a card id."""
-        df = cls.cards_data()
-        app = App.get_running_app()
-        root_source_dir = Path(app.config.get("paths", "source"))
-        root_dir = Path(app.config.get("paths", "output"))
-        root_dir.mkdir(exist_ok=True)
-
-        root_dir = root_dir.joinpath(project_name)
-        root_dir.mkdir(exist_ok=True)
-
-        card_data = df.loc[df["Card ID"] == card_id].iloc[0].to_dict()
-        top_level_folder = card_data["Folder Name"]
-        top_level_folder.mkdir(exist_ok=True)
-
-        tcg_file_name = card_data["File, TCG"]
-        ocg_file_name = card_data["File, OCG"]
-
-        tcg_file_prefix = tcg_file_name[0:2]
-        source_file_path_tcg = root_source_dir.joinpath(
-            top_level_folder, tcg_file_prefix, tcg_file_name
-        )
-
-        ocg_file_prefix = ocg_file_name[0:2]
-        source_file_path_ocg = root_source_dir.joinpath(
-            top_level_folder, ocg_file_prefix, ocg_file_name
-        )
-
-        file_path_tcg = root_dir.joinpath(
-            top_level_folder, tcg_file_prefix, tcg_file_name
-        )
-        file_path_ocg = root_dir.joinpath(
-            top_level_folder, ocg_file_prefix, ocg_file_name
-        )
 
-        save_tos = {}
-        if source_file_path_tcg.exists() and source_file_path_tcg.is_file():
-            save_tos[source_file_path_tcg] = file_path_tcg
-        if source_file_path_ocg.exists() and source_file_path_ocg.is_file():
-            save_tos[source_file_path_ocg] = file_path_ocg
+def make_texture(size, buffer):
+    """Upload RGBA pixels to a new texture, must run on the UI thread."""
+    from kivy.graphics.texture import Texture
 
-        for source, dest in save_tos.items():
-            env = UnityPy.load(f"{source}")
-            for obj in env.objects:
-                if obj.type.name in ["Texture2D"]:
-                    data = obj.read()
-                    path = obj.container
-                    if path is None:
-                        path = data.name
-                    resouce_name = Path(path).stem
-                    card_id = str(card_id)
-                    if resouce_name == card_id:
-                        data.image = image.convert("RGBA")
-                        data.save()
-                        dest.parent.mkdir(exist_ok=True)
-                        dest.write_bytes(env.files[0].save())
+    texture = Texture.create(size=size, colorfmt="rgba", bufferfmt="ubyte")
+    texture.blit_buffer(buffer, colorfmt="rgba", bufferfmt="ubyte")
+    # PIL rows run top to bottom, textures bottom to top
+    texture.flip_vertical()
+    return texture
 
 
 class CardData:
-    """Data of an individual card."""
+    """
+    Data of an individual card.
+
+    Card rows and edits are kept for every card used. Unedited images and
+    textures can be reloaded from the game files so they are kept in a
+    memory bounded LRU instead, edited images are pinned in the card data
+    as they are the only copy of the user's work.
+    """
 
     _lock = threading.Lock()
     _async_lock = asyncio.Lock()
     _card_data_store = {}
+    # Loads in progress by cache key, shared by concurrent callers
+    _in_flight = {}
+    _image_cache = LruCache(max_bytes=512 * 1024 * 1024, sizeof=image_nbytes)
+    # Decode textures in worker processes instead of threads
+    process_decode = False
 
     def __init__(self, card_id):
         """Create a dummy card."""
@@ -174,6 +394,23 @@ class CardData:
         """Remove all loaded card data."""
         with cls._lock:
             cls._card_data_store.clear()
+            cls._image_cache.clear()
+            cls._in_flight.clear()
+
+    @classmethod
+    def set_cache_budget(cls, max_bytes):
+        """Set the memory budget of unedited images and textures."""
+        cls._image_cache.resize(max_bytes=max_bytes)
+
+    @classmethod
+    def set_process_decode(cls, enabled):
+        """Choose to decode textures in worker processes or threads."""
+        cls.process_decode = enabled
+
+    @classmethod
+    def cache_stats(cls):
+        """Get the hit, miss and eviction counters of the image cache."""
+        return cls._image_cache.stats()
 
     @classmethod
     def edited_cards(cls):
@@ -185,15 +422,14 @@ class CardData:
         ]
 
     def update_data(self):
-        """Get or load from global csv data."""
+        """Get or load from the card catalogue."""
         cls = type(self)
         card_id = self.card_id
         if card_id not in cls._card_data_store:
+            record = LoadData.catalogue()[card_id]
             with cls._lock:
                 if card_id not in cls._card_data_store:
-                    df = LoadData.main_cards_data()
-                    data = df[(df["Card ID"] == card_id)].iloc[0].to_dict()
-                    data["edited"] = {}
+                    data = {"record": record, "edited": {}}
 
                     cls._card_data_store[card_id] = data
 
@@ -201,58 +437,167 @@ class CardData:
 
     async def get_name(self):
         """Get the card name."""
-        return self.data["English Name"]
+        return self.data["record"].english_name
+
+    async def _single_flight(self, key, factory):
+        """
+        Share one load between every concurrent caller asking for a key.
+
+        The load runs as its own task so cancelling a caller doesn't cancel
+        it for the others.
+
+        :param factory: function returning the coroutine that loads
+        """
+        cls = type(self)
+        task = cls._in_flight.get(key, None)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            cls._in_flight[key] = task
+
+            def finished(task):
+                if cls._in_flight.get(key, None) is task:
+                    del cls._in_flight[key]
+                if not task.cancelled():
+                    # Retrieve it so asyncio doesn't warn if nobody awaits
+                    task.exception()
+
+            task.add_done_callback(finished)
+        return await asyncio.shield(task)
 
     async def get_image(self):
         """Get the image."""
-        if "image" not in self.data:
-            cls = type(self)
+        if "image" in self.data:
+            return self.data["image"]
+        cls = type(self)
+        key = (self.card_id, "image")
+        image = cls._image_cache.get(key, _missing)
+        if image is _missing:
+            image = await self._single_flight(key, self._load_image)
+        return image
+
+    async def _load_image(self):
+        """Load the unedited image and cache it."""
+        cls = type(self)
+        if cls.process_decode:
+            image = await LoadData.image_in_process(self.card_id)
+        else:
             image = await Async().async_thread(lambda: LoadData.image(self.card_id))
-            async with cls._async_lock:
-                if "image" not in self.data:
-                    self.data["image"] = image
-        return self.data["image"]
-
-    async def get_core_image(self):
-        """Get the image in CoreImage format."""
-        if "core_image" not in self.data:
-            image = await self.get_image()
-            if image:
-                buf = io.BytesIO()
-                image.save(buf, format="PNG")
-                buf.seek(0)
-                card_image = CoreImage(buf, ext="png")
-
-                cls = type(self)
-                async with cls._async_lock:
-                    if "core_image" not in self.data:
-                        self.data["core_image"] = card_image
-        return self.data.get("core_image", None)
+        async with cls._async_lock:
+            if "image" in self.data:
+                return self.data["image"]
+            cls._image_cache.put((self.card_id, "image"), image)
+        return image
+
+    async def get_texture(self):
+        """Get the image as a texture."""
+        cls = type(self)
+        key = (self.card_id, "texture")
+        texture = cls._image_cache.get(key, None)
+        if texture is None:
+            texture = await self._single_flight(key, self._load_texture)
+        return texture
+
+    async def _load_texture(self):
+        """Make a texture of the image and cache it."""
+        cls = type(self)
+        image = await self.get_image()
+        if image is None:
+            return None
+        size, buffer = await Async().async_thread(lambda: rgba_buffer(image))
+        texture = make_texture(size, buffer)
+
+        async with cls._async_lock:
+            # Don't cache a texture of an image replaced meanwhile
+            if self.data.get("image", image) is image:
+                cls._image_cache.put((self.card_id, "texture"), texture)
+        return texture
+
+    async def get_thumbnail(self, size):
+        """Get a downscaled texture for the card grid."""
+        if self.edited("image"):
+            return await self.get_texture()
+        cls = type(self)
+        key = (self.card_id, "thumbnail", size)
+        texture = cls._image_cache.get(key, None)
+        if texture is None:
+            texture = await self._single_flight(key, lambda: self._load_thumbnail(size))
+        return texture
+
+    async def _load_thumbnail(self, size):
+        """Load the thumbnail texture and cache it."""
+        cls = type(self)
+        if cls.process_decode:
+            path = await LoadData.thumbnail_in_process(self.card_id, size)
+        else:
+            path = await Async().async_thread(
+                lambda: LoadData.thumbnail(self.card_id, size)
+            )
+        if path is None:
+            return None
+        loaded = await Async().async_thread(lambda: read_thumbnail(path))
+        texture = make_texture(*loaded)
+        cls._image_cache.put((self.card_id, "thumbnail", size), texture)
+        return texture
 
     async def set_image(self, image):
         """Set the image."""
         old_image = await self.get_image()
-        old_hash = perceptiveHash(old_image)
-        new_hash = perceptiveHash(image)
-        if old_hash != new_hash:
-            if "image" in self.data:
-                current_size = old_image.size
-                if current_size != image.size:
-                    image = image.resize(current_size, PIL.Image.BICUBIC)
+        if old_image is not None:
+            image = await Async().async_thread(lambda: fit_image(old_image, image))
+            if image is None:
+                return
+        await self.replace_image(image)
+
+    async def replace_image(self, image):
+        """Set an image already compared and sized against the card's art."""
+        cls = type(self)
+        async with cls._async_lock:
             self.data["image"] = image
             self.data["edited"]["image"] = True
-            try:
-                self.data.pop("core_image")
-            except KeyError:
-                pass
+            for kind in ("image", "texture"):
+                cls._image_cache.pop((self.card_id, kind))
+                # Later callers must not join a load of the old image
+                cls._in_flight.pop((self.card_id, kind), None)
+
+    @classmethod
+    async def commit_all(cls, project_name, card_ids=None):
+        """
+        Save the edits of many cards to disk.
+
+        Edits are grouped by bundle so each bundle is parsed and written
+        once, independent bundles are written in parallel.
+        """
+        if card_ids is None:
+            card_ids = cls.edited_cards()
+        images = {}
+        for card_id in card_ids:
+            card_data = cls(card_id)
+            if card_data.edited("image"):
+                images[card_id] = await card_data.get_image()
+        if not images:
+            return
+
+        source_dir = LoadData.source_dir()
+        output_dir = LoadData.output_dir().joinpath(project_name)
+        plan = LoadData.plan_commit(images, source_dir=source_dir)
+
+        def save_task(bundle, bundle_images):
+            return lambda: LoadData.save_bundle(
+                source_dir.joinpath(bundle),
+                output_dir.joinpath(bundle),
+                bundle_images,
+            )
+
+        await asyncio.gather(
+            *(
+                Async().async_thread(save_task(bundle, bundle_images))
+                for (bundle, bundle_images) in plan.items()
+            )
+        )
 
     async def commit(self, project_name):
         """Save changes to disk."""
-        if self.data["edited"]:
-            image = await self.get_image()
-            await Async().async_thread(
-                lambda: LoadData.save_image(self.card_id, image, project_name)
-            )
+        await type(self).commit_all(project_name, [self.card_id])
 
     def edited(self, kind=None):
         """Check if data is edited."""
@@ -2,11 +2,9 @@
 
 from kivy.uix.gridlayout import GridLayout
 from kivy.properties import ObjectProperty
-from kivy.core.image import Image as CoreImage
 from kivy.app import App
 from PIL import Image as PilImage
 
-import io
 import asyncio
 
 from witchcrafted.utils import Async
@@ -14,6 +12,13 @@ from witchcrafted.cards.card_data import CardData
 from witchcrafted.dialogs import LoadDialog, SaveDialog
 
 
+def open_image(file_path):
+    """Open and decode an image file."""
+    image = PilImage.open(file_path)
+    image.load()
+    return image
+
+
 class CardEdit(GridLayout):
     """Card edit view."""
 
@@ -35,12 +40,7 @@ class CardEdit(GridLayout):
         async with self._card_lock:
             card_data = CardData(new_card_id)
             self.card_name = await card_data.get_name()
-            image = await card_data.get_image()
-            if image is not None:
-                buf = io.BytesIO()
-                image.save(buf, format="PNG")
-                buf.seek(0)
-                self.card_image = CoreImage(buf, ext="png")
+            self.card_image = await card_data.get_texture()
 
     def export_image(self):
         """Export the image."""
@@ -59,7 +59,7 @@ class CardEdit(GridLayout):
             async with self._card_lock:
                 card_data = CardData(self.card_id)
                 image = await card_data.get_image()
-                image.save(file_path)
+                await Async().async_thread(lambda: image.save(file_path))
 
     def import_image(self):
         """Import an image."""
@@ -75,7 +75,7 @@ class CardEdit(GridLayout):
         if file_paths:
             file_path = file_paths[0]
             async with self._card_lock:
-                image = PilImage.open(file_path)
+                image = await Async().async_thread(lambda: open_image(file_path))
                 card_data = CardData(self.card_id)
                 await card_data.set_image(image)
             await self.async_update_card(self.card_id)
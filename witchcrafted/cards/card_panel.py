@@ -1,11 +1,11 @@
 """An individual card panel."""
 
 from kivy.uix.gridlayout import GridLayout
-from kivy.properties import ObjectProperty
+from kivy.properties import ObjectProperty, NumericProperty
 from kivy.uix.behaviors.button import ButtonBehavior
-import asyncio
 
 from witchcrafted.cards.card_data import CardData
+from witchcrafted.cards.load_scheduler import LoadScheduler
 from witchcrafted.utils import Async
 
 
@@ -16,11 +16,12 @@ class CardPanel(ButtonBehavior, GridLayout):
     card_id = ObjectProperty(None, allownone=True)
     card_image = ObjectProperty(None, allownone=True)
     card_name = ObjectProperty(None, allownone=True)
+    thumbnail_size = NumericProperty(256)
 
     def __init__(self, **kwargs):
         """Init the view."""
         super().__init__(**kwargs)
-        self._card_lock = asyncio.Lock()
+        self._update_task = None
 
     def on_card_id(self, instance, new_card_id):
         """Act on card id changing."""
@@ -28,15 +29,22 @@ class CardPanel(ButtonBehavior, GridLayout):
         self.update_card()
 
     def update_card(self):
-        """Update the card."""
-        Async().async_task(self.async_update_card())
+        """Update the card, abandoning the load of the previous one."""
+        if self._update_task is not None:
+            self._update_task.cancel()
+        self.card_image = None
+        self._update_task = Async().async_task(self.async_update_card())
 
     async def async_update_card(self):
         """Async update data from card_id."""
         new_card_id = self.card_id
-        async with self._card_lock:
-            card_data = CardData(new_card_id)
-            self.card_name = await card_data.get_name()
-            core_image = await card_data.get_core_image()
-            if core_image is not None:
-                self.card_image = core_image
+        if new_card_id is None:
+            return
+        card_data = CardData(new_card_id)
+        self.card_name = await card_data.get_name()
+        size = self.thumbnail_size
+        texture = await LoadScheduler.shared().load(
+            new_card_id, lambda: card_data.get_thumbnail(size), size
+        )
+        if texture is not None and self.card_id == new_card_id:
+            self.card_image = texture
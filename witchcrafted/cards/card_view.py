@@ -4,13 +4,16 @@ The infinite scrolling card view.
 Cards are selectable for edit.
 """
 
-import asyncio
-
 from kivy.uix.recycleview import RecycleView
 from kivy.uix.gridlayout import GridLayout
 from kivy.properties import ObjectProperty, NumericProperty
+from kivy.clock import Clock
 
 from witchcrafted.cards.card_data import LoadData, CardData
+from witchcrafted.cards.thumbnails import size_for
+from witchcrafted.cards.search import CardSearch
+from witchcrafted.cards.load_scheduler import LoadScheduler
+from witchcrafted.utils import Async, clamp
 
 
 class CardView(GridLayout):
@@ -19,58 +22,117 @@ class CardView(GridLayout):
     card_scroll = ObjectProperty(None)
     filter_box = ObjectProperty(None)
 
+    # Seconds without typing before the filter is applied
+    filter_delay = NumericProperty(0.2)
+
+    def __init__(self, **kwargs):
+        """Init the view."""
+        super().__init__(**kwargs)
+        self._filter_text = ""
+        self._filter_trigger = Clock.create_trigger(
+            self.apply_filter, self.filter_delay
+        )
+
     def reset_panels(self):
         """Reset the panels by resetting their card IDs."""
         self.card_scroll.refresh_from_data()
 
     def filter_cards(self, text):
-        """Filter cards by name."""
-        self.card_scroll.filter_cards(text)
+        """Filter cards by name once typing pauses."""
+        self._filter_text = text
+        self._filter_trigger.cancel()
+        self._filter_trigger()
+
+    def apply_filter(self, *args):
+        """Filter cards by the last text typed."""
+        self.card_scroll.filter_cards(self._filter_text)
 
 
 class CardScroll(RecycleView):
-    """The scrolling cardview."""
+    """
+    The scrolling cardview.
+
+    The grid is sized for every card of the current filter up front, so
+    scrolling never moves, and panel data is filled in pages sliced from
+    the card ID array as the viewport gets near the end of it.
+    """
 
     card_grid = ObjectProperty(None)
 
     num_of_columns = NumericProperty(4)
     num_of_rows = NumericProperty(4)
 
+    # Height of a card panel, matches default_size of the card grid
+    row_height = NumericProperty(400)
+    # Height of the grid holding every card of the filter
+    grid_height = NumericProperty(0)
+    # Rows of panel data added at once
+    page_rows = NumericProperty(16)
+    # Panels in front of the loaded ones to generate thumbnails for
+    warm_ahead_rows = NumericProperty(8)
+    # Screens of cards to prefetch in the scroll direction
+    prefetch_screens = NumericProperty(2)
+
+    # Card IDs of the current filter, the kv rules apply before they load
+    card_ids = ()
+
     def __init__(self, **kwargs):
         """Create data and build."""
         super().__init__(**kwargs)
-        self.df = LoadData.main_cards_data()
-        self.fill_data(10)
+        self._warm_generation = 0
+        self._last_offset = 0
+        catalogue = LoadData.catalogue()
+        self.card_ids = catalogue.folder_ids()
+        self.search = CardSearch(catalogue, self.card_ids)
+        Async().thread_fire(self.search.build)
+        self.update_geometry()
+        self.fill_data(self.page_rows)
+
+    @property
+    def thumbnail_size(self):
+        """Get the thumbnail size fitting a card panel."""
+        width = self.width / self.num_of_columns if self.num_of_columns else 0
+        return size_for(max(width, self.row_height))
+
+    @property
+    def loaded_rows(self):
+        """Get the number of rows with panel data."""
+        return -(-len(self.data) // self.num_of_columns)
+
+    def on_num_of_columns(self, instance, value):
+        """Resize the grid for the new row count."""
+        self.update_geometry()
+
+    def on_row_height(self, instance, value):
+        """Resize the grid for the new row height."""
+        self.update_geometry()
+
+    def update_geometry(self):
+        """Size the grid for every card of the filter."""
+        rows = -(-len(self.card_ids) // self.num_of_columns)
+        self.grid_height = rows * self.row_height
 
     def filter_cards(self, text):
-        """Filter cards by name."""
-        df = LoadData.main_cards_data()
-        df = df[df["English Name"].str.contains(text)]
-        self.df = df
+        """Filter cards by any of their names, best matches first."""
+        self.card_ids = self.search.filter(text)
+        self._warm_generation += 1
+        self._last_offset = 0
         self.data.clear()
-        self.fill_data(10)
+        self.update_geometry()
+        self.scroll_y = 1
+        self.fill_data(self.page_rows)
         self.reset_panels()
 
     def scroll_data(self):
-        """Fill the grid with more cards."""
-        try:
-            top = (self.card_grid.top - self.y) / self.card_grid.height
-            if self.scroll_y * self.card_grid.height < self.height / 2:
-                print("== Before ==")
-                print(f"top: {top}")
-                print(f"scroll_y: {self.scroll_y}")
-                print(f"height: {self.height}")
-                print(f"card_grid.height: {self.card_grid.height}")
-                self.fill_data(4)
-                y = top + self.height
-                self.scroll_y = y / self.card_grid.height
-                print("== After ==")
-                print(f"top: {top}")
-                print(f"scroll_y: {self.scroll_y}")
-                print(f"height: {self.height}")
-                print(f"card_grid.height: {self.card_grid.height}")
-        except ZeroDivisionError:
-            pass
+        """Fill the grid with more cards when the viewport nears the end."""
+        rows = self.update_viewport()
+        if rows is None:
+            return
+        (last_row, rows_ahead) = rows
+        missing = last_row + 1 + rows_ahead - self.loaded_rows
+        if missing > 0:
+            pages = -(-missing // self.page_rows)
+            self.fill_data(pages * self.page_rows)
 
     def reset_panels(self):
         """Reset the panels by resetting their card IDs."""
@@ -78,32 +140,74 @@ class CardScroll(RecycleView):
 
     def fill_data(self, num_of_rows):
         """Fill so many rows of data."""
-        df = self.df[
-            len(self.data) : len(self.data) + num_of_rows * self.num_of_columns  # noqa
-        ]
-
-        def map_data(card_row):
-            card_data = card_row[1].to_dict()
-            return {
-                "card_id": card_data["Card ID"],
-                "card_image": None,
-                "card_name": None,
-            }
-
-        data = list(
-            map(
-                map_data,
-                df.iterrows(),
+        start = len(self.data)
+        stop = start + num_of_rows * self.num_of_columns
+        card_ids = self.card_ids[start:stop]
+        if not card_ids:
+            return
+        thumbnail_size = self.thumbnail_size
+
+        self.data.extend(
+            [
+                {
+                    "card_id": card_id,
+                    "card_image": None,
+                    "card_name": None,
+                    "thumbnail_size": thumbnail_size,
+                }
+                for card_id in card_ids
+            ]
+        )
+        self.warm_thumbnails()
+        self.update_viewport()
+
+    def warm_thumbnails(self):
+        """Generate thumbnails of the cards about to be scrolled to."""
+        start = len(self.data)
+        end = start + self.warm_ahead_rows * self.num_of_columns
+        card_ids = self.card_ids[start:end]
+        if not card_ids:
+            return
+        size = self.thumbnail_size
+        source_dir = LoadData.source_dir()
+        generation = self._warm_generation
+
+        def cancelled():
+            return generation != self._warm_generation
+
+        Async().thread_fire(
+            lambda: LoadData.warm_thumbnails(
+                card_ids, size, source_dir=source_dir, cancelled=cancelled
             )
         )
-        #  Async().async_fire(self.pre_load(data))
-        self.data.extend(data)
-
-    async def pre_load(self, data):
-        """Start preloading any data."""
-        for datum in data:
-            card_id = datum["card_id"]
-            if card_id:
-                card_data = CardData(card_id)
-                await card_data.get_core_image()
-                await asyncio.sleep(0.2)
+
+    def update_viewport(self):
+        """
+        Tell the load scheduler which cards are visible and coming next.
+
+        :return: (last visible row, rows to prefetch) or None before the
+                 grid is laid out
+        """
+        if not self.grid_height or not self.height:
+            return None
+        overflow = max(self.grid_height - self.height, 0)
+        offset = (1 - clamp(self.scroll_y, 0, 1)) * overflow
+        first_row = int(offset // self.row_height)
+        last_row = int((offset + self.height) // self.row_height)
+        rows_ahead = self.prefetch_screens * max(last_row - first_row, 1)
+        if offset >= self._last_offset:
+            ahead_rows = (last_row + 1, last_row + 1 + rows_ahead)
+        else:
+            ahead_rows = (max(first_row - rows_ahead, 0), first_row)
+        self._last_offset = offset
+
+        columns = self.num_of_columns
+        visible = self.card_ids[first_row * columns : (last_row + 1) * columns]  # noqa
+        ahead = self.card_ids[ahead_rows[0] * columns : ahead_rows[1] * columns]  # noqa
+        size = self.thumbnail_size
+        scheduler = LoadScheduler.shared()
+        scheduler.set_viewport(visible, ahead, size)
+        scheduler.prefetch(
+            ahead, lambda card_id: CardData(card_id).get_thumbnail(size), size
+        )
+        return last_row, rows_ahead
@@ -0,0 +1,371 @@
+"""
+Card catalogue.
+
+Card metadata from card_list.csv held column by column and indexed by
+card ID, so looking a card up is a dict access rather than a scan of the
+whole table and no per row dict is built.
+
+The CSV is compiled once into a columnar file in the cache directory that
+is memory mapped on start up, it is rebuilt when the CSV changes. Numbers
+are stored as native arrays, text as one UTF-8 blob per column with row
+offsets and decoded only when a value is read.
+"""
+
+import csv
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+from array import array
+from pathlib import Path
+
+from witchcrafted.utils import cache_dir, make_logger
+
+logger = make_logger(__name__)
+
+COLUMNS = [
+    "Card ID",
+    "Container",
+    "Folder Name",
+    "File, TCG",
+    "File, OCG",
+    "Cen?",
+    "Patched?",
+    "Art #",
+    "English Name",
+    "Japanese Name",
+    "German Name",
+    "Korean Name",
+]
+
+NAME_COLUMNS = ["English Name", "Japanese Name", "German Name", "Korean Name"]
+
+MAIN_FOLDER = "0000"
+
+# Values read as missing, like pandas did
+MISSING_VALUES = ("", "#N/A")
+
+INT_COLUMNS = ["Card ID"]
+FLOAT_COLUMNS = ["Art #"]
+
+MAGIC = b"WCCAT\0\0\0"
+FORMAT_VERSION = 1
+# Written in native byte order, a file from another machine reads wrong
+BYTE_ORDER_MARK = 0x01020304
+# magic, version, byte order mark, CSV mtime, CSV size, descriptor offset
+# and size
+HEADER = struct.Struct("=8sIIqqqq")
+ALIGNMENT = 8
+
+
+class StringColumn:
+    """A text column read from a blob of UTF-8 and row offsets into it."""
+
+    __slots__ = ("_blob", "_offsets")
+
+    def __init__(self, blob, offsets):
+        """Create the column, offsets has one more item than there are rows."""
+        self._blob = blob
+        self._offsets = offsets
+
+    def __len__(self):
+        """Get the number of rows."""
+        return len(self._offsets) - 1
+
+    def __getitem__(self, row):
+        """Get the text of a row, None if it is missing."""
+        start = self._offsets[row]
+        end = self._offsets[row + 1]
+        if start == end:
+            return None
+        return str(self._blob[start:end], "utf-8")
+
+    def __iter__(self):
+        """Iterate over the texts of all rows."""
+        return (self[row] for row in range(len(self)))
+
+
+def _parse_int(value):
+    """Parse a value of an integer column."""
+    return int(value) if value not in MISSING_VALUES else 0
+
+
+def _parse_float(value):
+    """Parse a value of a float column, NaN if it is missing."""
+    return float(value) if value not in MISSING_VALUES else math.nan
+
+
+def compile_catalogue(csv_path):
+    """
+    Compile the card list into the columnar format.
+
+    :return: the bytes of the compiled file
+    """
+    csv_path = Path(csv_path)
+    stat = csv_path.stat()
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = [row for row in reader if row]
+
+    body = bytearray(HEADER.size)
+
+    def add_section(data):
+        body.extend(b"\0" * (-len(body) % ALIGNMENT))
+        offset = len(body)
+        body.extend(data)
+        return offset
+
+    columns = []
+    for (index, name) in enumerate(header):
+        values = [row[index] for row in rows]
+        if name in INT_COLUMNS:
+            data = array("q", map(_parse_int, values))
+            columns.append(
+                {"name": name, "kind": "q", "offset": add_section(data.tobytes())}
+            )
+        elif name in FLOAT_COLUMNS:
+            data = array("d", map(_parse_float, values))
+            columns.append(
+                {"name": name, "kind": "d", "offset": add_section(data.tobytes())}
+            )
+        else:
+            blob = bytearray()
+            offsets = array("I", [0])
+            for value in values:
+                if value not in MISSING_VALUES:
+                    blob.extend(value.encode("utf-8"))
+                offsets.append(len(blob))
+            columns.append(
+                {
+                    "name": name,
+                    "kind": "s",
+                    "offset": add_section(offsets.tobytes()),
+                    "blob": add_section(blob),
+                    "blob_size": len(blob),
+                }
+            )
+
+    folder_index = header.index("Folder Name")
+    id_index = header.index("Card ID")
+    main_ids = array(
+        "q", (int(row[id_index]) for row in rows if row[folder_index] == MAIN_FOLDER)
+    )
+    descriptor = {
+        "rows": len(rows),
+        "columns": columns,
+        "folders": {
+            MAIN_FOLDER: {
+                "offset": add_section(main_ids.tobytes()),
+                "count": len(main_ids),
+            }
+        },
+    }
+    descriptor = json.dumps(descriptor).encode("utf-8")
+    descriptor_offset = add_section(descriptor)
+    HEADER.pack_into(
+        body,
+        0,
+        MAGIC,
+        FORMAT_VERSION,
+        BYTE_ORDER_MARK,
+        stat.st_mtime_ns,
+        stat.st_size,
+        descriptor_offset,
+        len(descriptor),
+    )
+    return bytes(body)
+
+
+def _compiled_is_current(path, csv_path):
+    """Check if a compiled file exists and matches the CSV."""
+    try:
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+        stat = csv_path.stat()
+    except OSError:
+        return False
+    if len(header) != HEADER.size:
+        return False
+    (magic, version, mark, mtime, size, _, _) = HEADER.unpack(header)
+    return (
+        magic == MAGIC
+        and version == FORMAT_VERSION
+        and mark == BYTE_ORDER_MARK
+        and mtime == stat.st_mtime_ns
+        and size == stat.st_size
+    )
+
+
+class CardRecord:
+    """A card of the catalogue, read through to the catalogue's columns."""
+
+    __slots__ = ("catalogue", "row")
+
+    def __init__(self, catalogue, row):
+        """Create a record for a row of the catalogue."""
+        self.catalogue = catalogue
+        self.row = row
+
+    def __getitem__(self, column):
+        """Get a column value like a row dict."""
+        return self.catalogue.columns[column][self.row]
+
+    def __repr__(self):
+        """Debug print."""
+        return f"<{type(self).__name__} {self.card_id}: {self.english_name}>"
+
+    def get(self, column, default=None):
+        """Get a column value or a default if there is no such column."""
+        values = self.catalogue.columns.get(column, None)
+        if values is None:
+            return default
+        return values[self.row]
+
+    @property
+    def card_id(self):
+        """Get the card ID."""
+        return self.catalogue.card_ids[self.row]
+
+    @property
+    def folder(self):
+        """Get the top level folder of the card's bundles."""
+        return self["Folder Name"]
+
+    @property
+    def english_name(self):
+        """Get the english name."""
+        return self["English Name"]
+
+    def to_dict(self):
+        """Get the row as a dict."""
+        return {
+            column: values[self.row]
+            for (column, values) in self.catalogue.columns.items()
+        }
+
+
+class CardCatalogue:
+    """All cards of card_list.csv indexed by card ID."""
+
+    _lock = threading.Lock()
+
+    def __init__(self, columns, folder_ids=None, buffer=None):
+        """
+        Create the catalogue.
+
+        :param columns: dict of column name to a sequence of its values
+        :param folder_ids: dict of folder name to the precomputed IDs of its
+                           cards
+        :param buffer: the mapping the columns are views of, kept open for
+                       as long as the catalogue
+        """
+        self.columns = columns
+        self.card_ids = array("q", columns["Card ID"])
+        self._rows = {card_id: row for (row, card_id) in enumerate(self.card_ids)}
+        self._folder_ids = dict(folder_ids or {})
+        self._buffer = buffer
+
+    @classmethod
+    def compiled_path(cls, csv_path):
+        """Get where the compiled form of a card list is kept."""
+        return cache_dir().joinpath("catalogue", f"{Path(csv_path).stem}.bin")
+
+    @classmethod
+    def load(cls, csv_path):
+        """
+        Load the catalogue of a card list, compiling it if needed.
+
+        :param csv_path: path of card_list.csv
+        """
+        csv_path = Path(csv_path)
+        path = cls.compiled_path(csv_path)
+        with cls._lock:
+            if not _compiled_is_current(path, csv_path):
+                logger.info(f"Compiling {csv_path}")
+                data = compile_catalogue(csv_path)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+                tmp_path.write_bytes(data)
+                try:
+                    os.replace(tmp_path, path)
+                except OSError:
+                    # Windows won't replace a file another instance maps
+                    tmp_path.unlink()
+                    return cls.from_buffer(memoryview(data))
+            with open(path, "rb") as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.from_buffer(memoryview(buffer), buffer)
+
+    @classmethod
+    def from_buffer(cls, view, buffer=None):
+        """Create the catalogue from the memoryview of a compiled file."""
+
+        def section(offset, size):
+            end = offset + size
+            return view[offset:end]
+
+        (_, _, _, _, _, offset, size) = HEADER.unpack_from(view)
+        descriptor = json.loads(str(section(offset, size), "utf-8"))
+        rows = descriptor["rows"]
+
+        columns = {}
+        for column in descriptor["columns"]:
+            if column["kind"] == "s":
+                offsets = section(column["offset"], 4 * (rows + 1)).cast("I")
+                blob = section(column["blob"], column["blob_size"])
+                values = StringColumn(blob, offsets)
+            else:
+                values = section(column["offset"], 8 * rows).cast(column["kind"])
+            columns[column["name"]] = values
+
+        folder_ids = {
+            folder: array("q", section(ids["offset"], 8 * ids["count"]).cast("q"))
+            for (folder, ids) in descriptor["folders"].items()
+        }
+        return cls(columns, folder_ids=folder_ids, buffer=buffer or view)
+
+    def __len__(self):
+        """Get the number of cards."""
+        return len(self.card_ids)
+
+    def __contains__(self, card_id):
+        """Check for a card."""
+        return card_id in self._rows
+
+    def __iter__(self):
+        """Iterate over all records."""
+        return (CardRecord(self, row) for row in range(len(self.card_ids)))
+
+    def __getitem__(self, card_id):
+        """Get the record of a card, raising KeyError if it is unknown."""
+        return CardRecord(self, self._rows[card_id])
+
+    def get(self, card_id, default=None):
+        """Get the record of a card."""
+        row = self._rows.get(card_id, None)
+        if row is None:
+            return default
+        return CardRecord(self, row)
+
+    def row(self, card_id):
+        """Get the row of a card."""
+        return self._rows[card_id]
+
+    def folder_ids(self, folder=MAIN_FOLDER):
+        """Get the IDs of the cards in a folder, in card list order."""
+        card_ids = self._folder_ids.get(folder, None)
+        if card_ids is None:
+            folders = self.columns["Folder Name"]
+            card_ids = array(
+                "q",
+                (
+                    card_id
+                    for (card_id, card_folder) in zip(self.card_ids, folders)
+                    if card_folder == folder
+                ),
+            )
+            self._folder_ids[folder] = card_ids
+        return card_ids
@@ -0,0 +1,207 @@
+"""
+Card image load scheduler.
+
+Sits between the card grid and CardData so that cards on screen are loaded
+first, the next screens in the scroll direction are prefetched, loads of
+cards that scrolled away are dropped before they start, and only a few
+bundle decodes run at once.
+"""
+
+import asyncio
+import heapq
+import itertools
+
+from witchcrafted.utils import Async
+
+PRIORITY_VISIBLE = 0
+PRIORITY_AHEAD = 1
+PRIORITY_OTHER = 2
+
+
+class _Job:
+    """A queued or running load of a card."""
+
+    __slots__ = (
+        "card_id",
+        "size",
+        "factory",
+        "priority",
+        "seq",
+        "future",
+        "waiters",
+        "started",
+    )
+
+    def __init__(self, card_id, size, factory, future):
+        """Create a job that has not been queued."""
+        self.card_id = card_id
+        self.size = size
+        self.factory = factory
+        self.future = future
+        self.priority = PRIORITY_OTHER
+        self.seq = 0
+        self.waiters = 0
+        self.started = False
+
+    @property
+    def key(self):
+        """Get what the job is shared by, the card and the size it loads at."""
+        return (self.card_id, self.size)
+
+
+class LoadScheduler:
+    """Priority queue of card loads with a cap on how many run at once."""
+
+    _instance = None
+
+    DEFAULT_CONCURRENT = 4
+
+    @classmethod
+    def shared(cls):
+        """Get the scheduler shared by the card grid."""
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, max_concurrent=DEFAULT_CONCURRENT):
+        """Create the scheduler."""
+        self.max_concurrent = max_concurrent
+        self._jobs = {}
+        self._queue = []
+        self._seq = itertools.count()
+        self._running = 0
+        self._visible = set()
+        self._ahead = set()
+        self._size = None
+
+    def _priority(self, job):
+        """Get the priority a job should run with."""
+        if job.size != self._size:
+            # Loads at a size the grid no longer shows
+            return PRIORITY_OTHER
+        if job.card_id in self._visible:
+            return PRIORITY_VISIBLE
+        if job.card_id in self._ahead:
+            return PRIORITY_AHEAD
+        return PRIORITY_OTHER
+
+    def _push(self, job):
+        """Queue a job at its current priority."""
+        job.priority = self._priority(job)
+        job.seq = next(self._seq)
+        heapq.heappush(self._queue, (job.priority, job.seq, job.key))
+
+    def _drop(self, job):
+        """Forget a job that nobody needs any more."""
+        if self._jobs.get(job.key, None) is job:
+            del self._jobs[job.key]
+        job.future.cancel()
+
+    def _wanted(self, job):
+        """Check if a job that has not started should still run."""
+        return job.waiters > 0 or self._priority(job) != PRIORITY_OTHER
+
+    def _pump(self):
+        """Start queued jobs, best priority first, up to the cap."""
+        while self._running < self.max_concurrent and self._queue:
+            (priority, seq, key) = heapq.heappop(self._queue)
+            job = self._jobs.get(key, None)
+            if job is None or job.started or job.seq != seq:
+                # Stale entry of a dropped or requeued job
+                continue
+            job.started = True
+            self._running += 1
+            Async().async_fire(self._run(job))
+
+    async def _run(self, job):
+        """Run a job and hand its result to everyone waiting."""
+        try:
+            result = await job.factory()
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+            if not job.waiters:
+                # Retrieve it so asyncio doesn't warn about it
+                job.future.exception()
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._running -= 1
+            if self._jobs.get(job.key, None) is job:
+                del self._jobs[job.key]
+            self._pump()
+
+    def _job(self, card_id, size, factory):
+        """Get the job of a card at a size, queuing a new one if needed."""
+        job = self._jobs.get((card_id, size), None)
+        if job is None:
+            job = _Job(card_id, size, factory, Async().async_future())
+            self._jobs[job.key] = job
+            self._push(job)
+        return job
+
+    async def load(self, card_id, factory, size=None):
+        """
+        Load a card through the queue.
+
+        Callers asking for the same card at the same size share one load.
+        If every caller is cancelled before the load starts and the card is
+        off screen the load is dropped.
+
+        :param factory: function returning the coroutine that loads the card
+        :param size: size the factory loads the card at
+        """
+        job = self._job(card_id, size, factory)
+        job.waiters += 1
+        self._pump()
+        try:
+            return await asyncio.shield(job.future)
+        finally:
+            job.waiters -= 1
+            if not job.started and not self._wanted(job):
+                self._drop(job)
+
+    def prefetch(self, card_ids, factory, size=None):
+        """
+        Queue loads nobody is waiting for yet.
+
+        :param factory: function taking a card ID and returning the
+                        coroutine that loads it
+        :param size: size the factory loads cards at
+        """
+        for card_id in card_ids:
+            if (card_id, size) not in self._jobs:
+                self._job(card_id, size, lambda card_id=card_id: factory(card_id))
+        self._pump()
+
+    def set_viewport(self, visible, ahead, size=None):
+        """
+        Update which cards are on screen and which are coming next.
+
+        Queued loads are reprioritized, loads of cards in neither or at
+        another size that nobody waits for are dropped.
+
+        :param size: size the cards are shown at
+        """
+        self._visible = set(visible)
+        self._ahead = set(ahead)
+        self._size = size
+        for job in list(self._jobs.values()):
+            if job.started:
+                continue
+            if not self._wanted(job):
+                self._drop(job)
+            elif job.priority != self._priority(job):
+                self._push(job)
+        self._pump()
+
+    def stats(self):
+        """Get the number of running and queued loads."""
+        return {
+            "running": self._running,
+            "queued": len(self._jobs) - self._running,
+        }
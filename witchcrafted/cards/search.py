@@ -0,0 +1,147 @@
+"""
+Card name search.
+
+A trigram index over the English, Japanese, German and Korean card names.
+Extending a query narrows the previous result instead of searching the
+whole catalogue again and results are ranked by how well a name matches.
+"""
+
+import threading
+import unicodedata
+from array import array
+
+from witchcrafted.cards.catalogue import NAME_COLUMNS
+
+GRAM_SIZE = 3
+
+# Ranks of a match, lower is better
+RANK_EXACT = 0
+RANK_PREFIX = 1
+RANK_WORD_PREFIX = 2
+RANK_SUBSTRING = 3
+
+
+def normalize(text):
+    """Normalize a name or query for case and width insensitive matching."""
+    if not isinstance(text, str):
+        return ""
+    return unicodedata.normalize("NFKC", text).casefold()
+
+
+def grams(text):
+    """Get the set of trigrams of a text."""
+    return {text[i : i + GRAM_SIZE] for i in range(len(text) - GRAM_SIZE + 1)}  # noqa
+
+
+class CardSearch:
+    """Searchable names of a list of cards."""
+
+    def __init__(self, catalogue, card_ids):
+        """
+        Keep the cards to search.
+
+        The names are normalized and indexed by build, until then queries
+        normalize the names of all the cards as they scan them.
+        """
+        self.catalogue = catalogue
+        self.card_ids = array("q", card_ids)
+        self.names = None
+        self.documents = None
+        self._index = None
+        self._lock = threading.Lock()
+        self._last_query = ""
+        self._last_rows = None
+
+    @property
+    def ready(self):
+        """Check if the trigram index is built."""
+        return self._index is not None
+
+    def build(self):
+        """Build the trigram index, safe to run in a thread."""
+        with self._lock:
+            if self._index is not None:
+                return
+            catalogue = self.catalogue
+            names = [
+                [normalize(catalogue[card_id][column]) for column in NAME_COLUMNS]
+                for card_id in self.card_ids
+            ]
+            # Names are joined with a newline so no trigram spans two names
+            documents = ["\n".join(row_names) for row_names in names]
+            (self.names, self.documents) = (names, documents)
+            index = {}
+            for (row, document) in enumerate(documents):
+                for gram in grams(document):
+                    postings = index.get(gram, None)
+                    if postings is None:
+                        index[gram] = [row]
+                    else:
+                        postings.append(row)
+            self._index = index
+
+    def _names(self, row):
+        """Get the normalized names of a row, normalizing them if not built."""
+        names = self.names
+        if names is not None:
+            return names[row]
+        card = self.catalogue[self.card_ids[row]]
+        return [normalize(card[column]) for column in NAME_COLUMNS]
+
+    def _candidates(self, query):
+        """Get rows that may contain the query, None if all of them may."""
+        index = self._index
+        if index is None or len(query) < GRAM_SIZE:
+            return None
+        postings = sorted((index.get(gram, ()) for gram in grams(query)), key=len)
+        rows = set(postings[0])
+        for other in postings[1:]:
+            if not rows:
+                break
+            rows.intersection_update(other)
+        return sorted(rows)
+
+    def _rank(self, row, query):
+        """Rank how well the best name of a row matches."""
+        rank = RANK_SUBSTRING
+        for name in self._names(row):
+            if name == query:
+                return RANK_EXACT
+            elif name.startswith(query):
+                rank = RANK_PREFIX
+            elif rank > RANK_WORD_PREFIX and f" {query}" in name:
+                rank = RANK_WORD_PREFIX
+        return rank
+
+    def filter(self, text):
+        """
+        Get the IDs of the cards matching a query, best matches first.
+
+        :param text: text to find in any of the card names
+        :return: array of card IDs, not to be modified as an empty query
+                 returns all the card IDs without a copy
+        """
+        query = normalize(text).strip()
+        if not query:
+            self._last_query = ""
+            self._last_rows = None
+            return self.card_ids
+
+        if self._last_rows is not None and self._last_query in query:
+            # Extending a query can only remove matches
+            rows = self._last_rows
+        else:
+            rows = self._candidates(query)
+            if rows is None:
+                rows = range(len(self.card_ids))
+        documents = self.documents
+        if documents is not None:
+            rows = [row for row in rows if query in documents[row]]
+        else:
+            rows = [row for row in rows if query in "\n".join(self._names(row))]
+        self._last_query = query
+        self._last_rows = rows
+
+        ranked = sorted(rows, key=lambda row: (self._rank(row, query), row))
+        card_ids = self.card_ids
+        return array("q", (card_ids[row] for row in ranked))
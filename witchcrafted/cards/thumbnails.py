@@ -0,0 +1,135 @@
+"""
+Card thumbnails.
+
+Downscaled card art for the card grid, stored on disk per grid size so
+panels can show a card without decoding its full texture from the bundle.
+Thumbnails are keyed by card ID and the mtime and size of the source
+bundle, so a game patch that changes a bundle regenerates its thumbnail.
+"""
+
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+from PIL import Image
+
+from witchcrafted.cards.bundle_index import BundleIndex
+from witchcrafted.utils import cache_dir, make_logger
+
+logger = make_logger(__name__)
+
+# Longest side of the thumbnails, in pixels
+THUMBNAIL_SIZES = (128, 256, 384, 512)
+
+
+def size_for(pixels):
+    """Get the smallest thumbnail size covering a panel of so many pixels."""
+    for size in THUMBNAIL_SIZES:
+        if size >= pixels:
+            return size
+    return THUMBNAIL_SIZES[-1]
+
+
+def make_thumbnail(card_id, bundles, size, source_dir):
+    """
+    Generate the thumbnail of a card in a worker process.
+
+    :return: (path of the thumbnail or None if the card has no art, the
+             bundle index entry for the parent's index)
+    """
+    BundleIndex.flush_interval = 0
+    thumbnails = ThumbnailCache.for_source(source_dir)
+    path = thumbnails.load(card_id, bundles, size)
+    return path, thumbnails.index.entries.get(str(card_id), None)
+
+
+class ThumbnailCache:
+    """On disk thumbnails of the cards in one source directory."""
+
+    _lock = threading.Lock()
+    _instances = {}
+
+    @classmethod
+    def for_source(cls, source_dir):
+        """Get the shared thumbnail cache of a source directory."""
+        source_dir = Path(source_dir).resolve()
+        if source_dir not in cls._instances:
+            with cls._lock:
+                if source_dir not in cls._instances:
+                    cls._instances[source_dir] = cls(source_dir)
+        return cls._instances[source_dir]
+
+    def __init__(self, source_dir):
+        """Create the cache of a source directory."""
+        self.source_dir = Path(source_dir)
+        self.index = BundleIndex.for_source(source_dir)
+        key = hashlib.sha1(f"{self.source_dir}".encode("utf-8")).hexdigest()[:16]
+        self.root = cache_dir().joinpath("thumbnails", key)
+
+    def path(self, card_id, size, entry):
+        """Get the thumbnail path of a card for its current bundle."""
+        return self.root.joinpath(
+            f"{size}", f"{card_id}-{entry['mtime']}-{entry['size']}.png"
+        )
+
+    def existing(self, card_id, bundles, size):
+        """Get the path of a card's thumbnail if it was already generated."""
+        entry = self.index.lookup(card_id, bundles)
+        if entry is None:
+            return None
+        path = self.path(card_id, size, entry)
+        if path.exists():
+            return path
+        return None
+
+    def load(self, card_id, bundles, size):
+        """
+        Get the thumbnail of a card, generating it if needed.
+
+        :param bundles: candidate bundle paths relative to the source dir
+        :param size: longest side of the thumbnail
+        :return: path of the thumbnail PNG or None if the card has no art
+        """
+        entry = self.index.lookup(card_id, bundles)
+        if entry is None:
+            return None
+        path = self.path(card_id, size, entry)
+        if path.exists():
+            return path
+        texture = self.index.read_texture(card_id, bundles)
+        if texture is None:
+            return None
+        return self.store(card_id, size, entry, texture.image)
+
+    def store(self, card_id, size, entry, image):
+        """Write the thumbnail of an image and remove stale ones."""
+        path = self.path(card_id, size, entry)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        image = image.copy()
+        image.thumbnail((size, size), Image.LANCZOS)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        image.save(tmp_path, format="PNG")
+        os.replace(tmp_path, path)
+        for stale in path.parent.glob(f"{card_id}-*.png"):
+            if stale != path:
+                try:
+                    stale.unlink()
+                except OSError:
+                    pass
+        return path
+
+    def warm(self, cards, size, cancelled=None):
+        """
+        Generate missing thumbnails in the background.
+
+        :param cards: list of (card_id, bundles)
+        :param cancelled: called between cards, stops warming if it is True
+        """
+        for (card_id, bundles) in cards:
+            if cancelled is not None and cancelled():
+                return
+            try:
+                self.load(card_id, bundles, size)
+            except Exception as e:
+                logger.warning(f"Failed to make thumbnail of {card_id}: {e}")
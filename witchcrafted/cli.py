@@ -0,0 +1,65 @@
+"""
+Masterduel modding tool.
+
+Usage:
+    masterduel [options]
+    masterduel extract <source> <output> [--folder=<folder>]...
+        [--from=<id>] [--to=<id>] [--jobs=<n>]
+    masterduel lookup <source> <image>... [--count=<n>] [--distance=<n>] [--jobs=<n>]
+    masterduel duplicates <source> [--distance=<n>] [--jobs=<n>]
+
+Commands:
+  extract       Dump the art of every card in the card list to <output>/<card_id>.png
+                without starting the app. Cards already extracted are skipped.
+  lookup        Find the cards whose original art is nearest to each image.
+  duplicates    List groups of cards that share the same art.
+
+Options:
+  -h --help           Show this screen.
+  --version           Show version.
+  --folder=<folder>   Only extract cards in this top level folder, e.g. 0000.
+  --from=<id>         Only extract cards with an ID of at least this.
+  --to=<id>           Only extract cards with an ID of at most this.
+  --jobs=<n>          Number of worker processes, defaults to the CPU count.
+  --count=<n>         Number of cards to list per image [default: 5].
+  --distance=<n>      Largest hamming distance between pHashes to match.
+"""
+
+import multiprocessing
+
+from colorama import init as colorama_init
+from docopt import docopt
+
+
+def main(argv=None, gui=None):
+    """
+    Parse the command line and run the app or a headless command.
+
+    :param gui: function taking the options to start the app, for callers
+                that already imported it
+    """
+    opts = docopt(__doc__, argv=argv)
+    colorama_init()
+
+    if opts.get("extract", False):
+        from witchcrafted import extract
+
+        extract.main(opts)
+        return
+
+    if opts.get("lookup", False) or opts.get("duplicates", False):
+        from witchcrafted import lookup
+
+        lookup.main(opts)
+        return
+
+    if gui is None:
+        # Kivy is only imported when the GUI is started
+        from witchcrafted.main import main as gui
+
+    gui(opts)
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
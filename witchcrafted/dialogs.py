@@ -3,7 +3,12 @@
 from kivy.uix.gridlayout import GridLayout
 from kivy.uix.popup import Popup
 from kivy.uix.label import Label
-from kivy.properties import ObjectProperty, BooleanProperty
+from kivy.properties import (
+    ObjectProperty,
+    BooleanProperty,
+    NumericProperty,
+    StringProperty,
+)
 from pathlib import Path
 
 from witchcrafted.utils import Async
@@ -170,3 +175,38 @@ class SaveDialog(GridLayout):
         popup.bind(on_dismiss=on_dismiss)
         popup.open()
         return await future
+
+
+class ProgressDialog(GridLayout):
+    """Progress of a long task, with a button to cancel it."""
+
+    text = StringProperty("")
+    value = NumericProperty(0)
+    max = NumericProperty(1)
+    cancelled = BooleanProperty(False)
+
+    @classmethod
+    def show(cls, title, text=""):
+        """Show the progress popup, it stays until dismissed."""
+        content = cls(text=text)
+        content.popup = Popup(
+            title=title,
+            content=content,
+            size_hint=(0.6, 0.3),
+            auto_dismiss=False,
+        )
+        content.popup.open()
+        return content
+
+    def update(self, done, total):
+        """Show how much of the task is done."""
+        self.max = max(total, 1)
+        self.value = done
+
+    def cancel(self):
+        """Ask the task to stop."""
+        self.cancelled = True
+
+    def dismiss(self):
+        """Close the popup."""
+        self.popup.dismiss()
@@ -0,0 +1,138 @@
+"""
+Headless bulk art extraction.
+
+Dumps card art from the game bundles to PNG files without the app running.
+Bundles are decoded across a process pool and cards that already have an
+output file are skipped, so an interrupted run resumes where it stopped.
+"""
+
+import concurrent.futures
+import os
+from pathlib import Path
+
+from witchcrafted.cards.bundle_index import BundleIndex
+from witchcrafted.cards.card_data import LoadData
+from witchcrafted.utils import make_logger, process_pool
+
+logger = make_logger(__name__)
+
+# How often to report progress, in cards
+PROGRESS_INTERVAL = 100
+
+
+def select_cards(folders=None, first=None, last=None):
+    """
+    Select the cards to extract.
+
+    :param folders: only include cards in these top level folders
+    :param first: lowest card ID to include
+    :param last: highest card ID to include
+    :return: list of (card_id, bundles) with bundles relative to the source dir
+    """
+    return [
+        (record.card_id, LoadData.bundle_candidates(record))
+        for record in LoadData.catalogue()
+        if (not folders or record.folder in folders)
+        and (first is None or record.card_id >= first)
+        and (last is None or record.card_id <= last)
+    ]
+
+
+def output_path(output_dir, card_id):
+    """Get the PNG path of a card."""
+    return Path(output_dir).joinpath(f"{card_id}.png")
+
+
+def init_worker():
+    """Set up a worker process."""
+    # Only the parent process writes the index to disk
+    BundleIndex.flush_interval = 0
+
+
+def extract_card(card_id, bundles, source_dir, output_dir):
+    """
+    Extract a single card in a worker process.
+
+    :return: (card_id, index entry) where the entry is None if the card
+             has no art in the source dir
+    """
+    index = BundleIndex.for_source(source_dir)
+    texture = index.read_texture(card_id, bundles)
+    if texture is None:
+        return card_id, None
+    dest = output_path(output_dir, card_id)
+    tmp_dest = dest.with_suffix(".part")
+    texture.image.save(tmp_dest, format="PNG")
+    os.replace(tmp_dest, dest)
+    return card_id, index.entries.get(str(card_id), None)
+
+
+def extract(source_dir, output_dir, folders=None, first=None, last=None, jobs=None):
+    """
+    Extract the art of many cards to PNG files.
+
+    :param source_dir: the dir containing the game bundles
+    :param output_dir: the dir to write <card_id>.png files to
+    :param jobs: number of worker processes, defaults to the CPU count
+    :return: (extracted, skipped, missing) counts
+    """
+    source_dir = Path(source_dir).resolve()
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    cards = select_cards(folders=folders, first=first, last=last)
+    todo = [
+        (card_id, bundles)
+        for (card_id, bundles) in cards
+        if not output_path(output_dir, card_id).exists()
+    ]
+    skipped = len(cards) - len(todo)
+    if skipped:
+        logger.info(f"Resuming, {skipped} cards already extracted")
+
+    index = BundleIndex.for_source(source_dir)
+    extracted = 0
+    missing = 0
+    executor = process_pool(jobs or os.cpu_count(), initializer=init_worker)
+    try:
+        futures = [
+            executor.submit(extract_card, card_id, bundles, source_dir, output_dir)
+            for (card_id, bundles) in todo
+        ]
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            try:
+                card_id, entry = future.result()
+            except Exception as e:
+                missing += 1
+                logger.error(f"Extraction failed: {e}")
+                continue
+            if entry is None:
+                missing += 1
+                logger.debug(f"No art found for {card_id}")
+            else:
+                extracted += 1
+                index.update(card_id, entry)
+            if done % PROGRESS_INTERVAL == 0:
+                logger.info(f"Extracted {done}/{len(todo)}")
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        index.flush()
+
+    logger.info(f"Extracted {extracted}, skipped {skipped}, missing {missing}")
+    return extracted, skipped, missing
+
+
+def main(opts):
+    """Run the extract command from docopt options."""
+    folders = opts.get("--folder", None)
+    first = opts.get("--from", None)
+    last = opts.get("--to", None)
+    jobs = opts.get("--jobs", None)
+    extract(
+        opts["<source>"],
+        opts["<output>"],
+        folders=folders,
+        first=int(first) if first is not None else None,
+        last=int(last) if last is not None else None,
+        jobs=int(jobs) if jobs else None,
+    )
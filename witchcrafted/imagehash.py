@@ -1,52 +1,127 @@
 """
-Pure python imagehash.
+NumPy imagehash.
 
-Source: https://github.com/bkda/ImageHash/blob/master/imglib.py
+Based on: https://github.com/bkda/ImageHash/blob/master/imglib.py
 
 Used instead of imagehash package to remove the scipy dependency.
+
+The DCT is evaluated with precomputed basis matrices over a whole stack of
+images at once. Products and sums are formed in the same order as the
+original pure python version so the hashes are bit-identical to it.
 """
 
-from functools import reduce
+from functools import lru_cache
+from math import cos, pi, sqrt
+
+import numpy as np
 from PIL import Image
 
+HASH_SIZE = 32
+
+# Number of images hashed per numpy pass, bounds the temporary arrays
+# to about 32MB
+BATCH_SIZE = 64
+
+
+@lru_cache(maxsize=None)
+def dct_basis(upper_left=8, size=HASH_SIZE):
+    """
+    Get the DCT basis matrix and coefficient scales.
+
+    Values are computed with math.cos/sqrt rather than numpy so they match
+    the scalar implementation exactly.
+
+    :param upper_left: number of low frequency coefficients per axis
+    :param size: side of the square input
+    :return: (basis, scale) where basis[p][m] is the cosine term of
+             frequency p at pixel m and scale[p][q] is alpha_p * alpha_q
+    """
+    basis = np.array(
+        [
+            [cos(pi * (2 * m + 1) * p / 2 / size) for m in range(size)]
+            for p in range(upper_left)
+        ],
+        dtype=np.float64,
+    )
+    alphas = []
+    for p in range(upper_left):
+        alpha = sqrt(1 / size)
+        if p != 0:
+            alpha = alpha * sqrt(2)
+        alphas.append(alpha)
+    scale = np.array(
+        [[alpha_p * alpha_q for alpha_q in alphas] for alpha_p in alphas],
+        dtype=np.float64,
+    )
+    basis.setflags(write=False)
+    scale.setflags(write=False)
+    return basis, scale
+
+
+def dct_coefficients_batch(pixels, upper_left=8):
+    """
+    Get the upper left corner of the DCT of a stack of images.
+
+    :param pixels: array of shape (count, 32, 32)
+    :param upper_left: use upper left corner
+    :return: array of shape (count, upper_left, upper_left)
+    """
+    pixels = np.asarray(pixels, dtype=np.float64)
+    count, size = pixels.shape[0], pixels.shape[1]
+    basis, scale = dct_basis(upper_left, size)
+    # terms[i, p, q, m, n] = pixels[i, m, n] * basis[p, m] * basis[q, n]
+    terms = pixels[:, None, :, :] * basis[None, :, :, None]
+    terms = terms[:, :, None, :, :] * basis[None, None, :, None, :]
+    terms = terms.reshape(count, upper_left, upper_left, size * size)
+    # cumsum accumulates strictly left to right like the builtin sum,
+    # np.sum would use pairwise summation and round differently
+    sums = np.cumsum(terms, axis=-1)[..., -1]
+    return scale * sums
+
 
 def dct_coefficients(data, upper_left=8):
     """
     Get the dct.
 
-    :param data:
+    :param data: the 32x32 pixels in row major order
     :param upper_left: use upper left corner
     :return:
     """
-    from math import cos, pi, sqrt
+    pixels = np.asarray(data, dtype=np.float64).reshape(1, HASH_SIZE, HASH_SIZE)
+    return dct_coefficients_batch(pixels, upper_left)[0].tolist()
 
-    A, M, N = [], 32, 32
-    coefficients = []
-    for i in range(32):
-        A.append([data.pop(0) for j in range(32)])
 
-    for p in range(upper_left):
-        tmp = []
-        alpha_p = sqrt(1 / M)
-        if p != 0:
-            alpha_p = alpha_p * sqrt(2)
-        for q in range(upper_left):
-            alpha_q = sqrt(1 / N)
-            if q != 0:
-                alpha_q = alpha_q * sqrt(2)
-            b = sum(
-                [
-                    A[m][n]
-                    * cos(pi * (2 * m + 1) * p / 2 / M)
-                    * cos(pi * (2 * n + 1) * q / 2 / N)
-                    for m in range(M)
-                    for n in range(N)
-                ]
-            )
-
-            tmp.append(alpha_p * alpha_q * b)
-        coefficients.append(tmp)
-    return coefficients
+def hash_pixels(img):
+    """Get the downscaled greyscale pixels that are hashed."""
+    if not isinstance(img, Image.Image):
+        img = Image.open(img)
+    im = img.resize((HASH_SIZE, HASH_SIZE), Image.ANTIALIAS).convert("L")
+    return np.asarray(im, dtype=np.float64)
+
+
+def hashes_from_pixels(pixels):
+    """Compute the pHash of a stack of downscaled pixel arrays."""
+    hashes = []
+    for start in range(0, len(pixels), BATCH_SIZE):
+        matrx = dct_coefficients_batch(pixels[start : start + BATCH_SIZE])  # noqa
+        flat = matrx.reshape(matrx.shape[0], -1)
+        avg = np.cumsum(flat, axis=-1)[:, -1:] / flat.shape[1]
+        bits = np.packbits(flat >= avg, axis=-1, bitorder="little")
+        hashes.extend(int.from_bytes(row.tobytes(), "little") for row in bits)
+    return hashes
+
+
+def perceptiveHashes(images):
+    """
+    Compute the pHash of many images in one call.
+
+    :param images: iterable of PIL images or paths
+    :return: list of hashes, as returned by perceptiveHash
+    """
+    pixels = np.array([hash_pixels(img) for img in images], dtype=np.float64)
+    if not len(pixels):
+        return []
+    return hashes_from_pixels(pixels)
 
 
 def perceptiveHash(img):
@@ -57,14 +132,4 @@ def perceptiveHash(img):
     :return: the upper left corner of the DCT,default return 8x8 coefficient matrix
               It can reduce the computational time efficiently.
     """
-    if not isinstance(img, Image.Image):
-        img = Image.open(img)
-    im = img.resize((32, 32), Image.ANTIALIAS).convert("L")
-    da = list(im.getdata())
-    matrx = dct_coefficients(da)
-    avg = sum([e for r in matrx for e in r]) / 64
-
-    binary_list = [0 if e < avg else 1 for r in matrx for e in r]
-    hs = reduce(lambda x, y_z: x | (y_z[1] << y_z[0]), enumerate(binary_list), 0)
-
-    return hs
+    return perceptiveHashes([img])[0]
@@ -0,0 +1,85 @@
+"""
+Headless reverse image lookup.
+
+Finds which cards loose art files replace, or which cards share art, using
+the pHash index of the original card art. The index is built on first use
+and only cards whose bundle changed are hashed again afterwards.
+"""
+
+from pathlib import Path
+
+from PIL import Image
+
+from witchcrafted.cards.art_index import ArtIndex
+from witchcrafted.cards.card_data import LoadData
+from witchcrafted.imagehash import perceptiveHash
+from witchcrafted.utils import make_logger
+
+logger = make_logger(__name__)
+
+# Default largest distance of a lookup match and of duplicate art
+LOOKUP_DISTANCE = 16
+DUPLICATE_DISTANCE = 0
+
+
+def open_index(source_dir, jobs=None):
+    """Get the art index of a source dir, bringing it up to date."""
+    index = ArtIndex.for_source(source_dir)
+    cards = [
+        (record.card_id, LoadData.bundle_candidates(record))
+        for record in LoadData.catalogue()
+    ]
+    index.build(cards, jobs=jobs)
+    return index
+
+
+def lookup(source_dir, images, count=5, max_distance=LOOKUP_DISTANCE, jobs=None):
+    """
+    Find the cards nearest to each image.
+
+    :param images: paths of the images to look up
+    :return: dict of image path to a list of (distance, card_id)
+    """
+    index = open_index(source_dir, jobs=jobs)
+    results = {}
+    for path in images:
+        with Image.open(path) as image:
+            art_hash = perceptiveHash(image)
+        results[path] = index.nearest(art_hash, count=count, max_distance=max_distance)
+    return results
+
+
+def main(opts):
+    """Run the lookup or duplicates command from docopt options."""
+    source_dir = Path(opts["<source>"])
+    jobs = int(opts["--jobs"]) if opts.get("--jobs", None) else None
+    distance = opts.get("--distance", None)
+
+    if opts.get("duplicates", False):
+        distance = int(distance) if distance is not None else DUPLICATE_DISTANCE
+        index = open_index(source_dir, jobs=jobs)
+        catalogue = LoadData.catalogue()
+        for group in index.duplicates(max_distance=distance):
+            print(
+                ", ".join(
+                    f"{card_id} ({catalogue[card_id].english_name})"
+                    for card_id in group
+                )
+            )
+        return
+
+    distance = int(distance) if distance is not None else LOOKUP_DISTANCE
+    catalogue = LoadData.catalogue()
+    results = lookup(
+        source_dir,
+        opts["<image>"],
+        count=int(opts["--count"]),
+        max_distance=distance,
+        jobs=jobs,
+    )
+    for (path, matches) in results.items():
+        if not matches:
+            print(f"{path}: no match")
+        for (distance, card_id) in matches:
+            name = catalogue[card_id].english_name
+            print(f"{path}: {card_id} {name} (distance {distance})")
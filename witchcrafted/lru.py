@@ -0,0 +1,128 @@
+"""
+Size aware LRU cache.
+
+Used to bound memory held by decoded images, textures and bundles.
+"""
+
+from collections import OrderedDict
+import threading
+
+
+class LruCache:
+    """
+    Thread safe LRU cache bounded by total size and entry count.
+
+    Entries are evicted least recently used first once either bound is
+    exceeded. A bound of None is unlimited.
+    """
+
+    def __init__(self, max_bytes=None, max_items=None, sizeof=None):
+        """
+        Create the cache.
+
+        :param max_bytes: budget for the sum of entry sizes
+        :param max_items: maximum number of entries
+        :param sizeof: function giving the size of a value in bytes
+        """
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.sizeof = sizeof if sizeof is not None else (lambda value: 0)
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        """Check for a key without counting a hit or miss."""
+        return key in self._entries
+
+    def __len__(self):
+        """Get the number of entries."""
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        """Get the total size of all entries."""
+        return self._bytes
+
+    def get(self, key, default=None):
+        """Get a value and mark it as recently used."""
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=None):
+        """Add or replace a value, evicting others to stay in budget."""
+        if size is None:
+            size = self.sizeof(value)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._bytes += size
+            self._evict()
+        return value
+
+    def pop(self, key, default=None):
+        """Remove a value and return it."""
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value = self._entries[key]
+            self._remove(key)
+            return value
+
+    def clear(self):
+        """Remove all values."""
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def resize(self, max_bytes=None, max_items=None):
+        """Change the bounds, evicting as needed."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self.max_items = max_items
+            self._evict()
+
+    def stats(self):
+        """Get the hit, miss and eviction counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "items": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+    def _remove(self, key):
+        """Remove a key if present, lock must be held."""
+        if key in self._entries:
+            del self._entries[key]
+            self._bytes -= self._sizes.pop(key)
+
+    def _over_budget(self):
+        """Check the bounds, lock must be held."""
+        if self.max_items is not None and len(self._entries) > self.max_items:
+            return True
+        return self.max_bytes is not None and self._bytes > self.max_bytes
+
+    def _evict(self):
+        """Evict least recently used entries, lock must be held."""
+        while self._entries and self._over_budget():
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
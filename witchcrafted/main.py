@@ -1,27 +1,31 @@
 """
-Masterduel modding tool.
+The app's GUI.
 
-Usage:
-    masterduel [options]
-
-Options:
-  -h --help     Show this screen.
-  --version     Show version.
+Importing this sets up Kivy, the command line lives in witchcrafted.cli.
 """
 
 import kivy
 from kivy.app import App as KivyApp
 from kivy.properties import ObjectProperty
 from kivy.clock import Clock
-import re
 
-from docopt import docopt
 import ctypes
-from colorama import init as colorama_init
+import multiprocessing
 from pathlib import Path
 import platform
 
-from witchcrafted.utils import Async, make_logger, get_md_paths, data_dir
+from witchcrafted.utils import (
+    Async,
+    LoopWatchdog,
+    make_logger,
+    get_md_paths,
+    get_md_profile,
+    data_dir,
+)
+from witchcrafted.cards.bundle_cache import BundleCache
+from witchcrafted.cards.bundle_index import BundleIndex
+from witchcrafted.cards.card_data import CardData
+from witchcrafted.cards.load_scheduler import LoadScheduler
 
 
 kivy.require("2.1.0")
@@ -49,6 +53,10 @@ kv_directory_str = f"{kv_directory_path}"
 kivy.resources.resource_add_path(f"{data_path}")
 kivy.resources.resource_add_path(kv_directory_str)
 
+# Image cache budget in megabytes, settings below the minimum are raised
+DEFAULT_CACHE_MB = 512
+MIN_CACHE_MB = 64
+
 
 class WitchcraftedApp(KivyApp):
     """Main GUI app."""
@@ -76,13 +84,7 @@ class WitchcraftedApp(KivyApp):
         md_paths = get_md_paths()
         if md_paths:
             md_path = md_paths[0]
-            local_dir = md_path.joinpath("LocalData")
-            profile_dir = None
-            for profile in local_dir.iterdir():
-                if profile.name != "00000000" and re.match(
-                    r"^[0-9a-f]+$", profile.name
-                ):
-                    profile_dir = profile
+            profile_dir = get_md_profile(md_path)
             if not profile_dir:
                 profile_dir = Path("./masterduel/source")
             masterduel_data = md_path.joinpath("masterduel_Data")
@@ -108,9 +110,61 @@ class WitchcraftedApp(KivyApp):
             )
         config.setdefaults(
             "app",
-            {"debug": False},
+            {
+                "debug": False,
+                "image_cache_mb": DEFAULT_CACHE_MB,
+                "process_decode": False,
+            },
         )
 
+    def on_start(self):
+        """Apply the loaded config."""
+        self.apply_cache_budget()
+        self.apply_process_decode()
+        self.watchdog = None
+        if self.config.getboolean("app", "debug"):
+            self.watchdog = LoopWatchdog(Async().loop)
+            self.watchdog.start()
+
+    def on_stop(self):
+        """Stop debugging aids."""
+        if self.watchdog is not None:
+            self.watchdog.stop()
+            for (name, stats) in Async().pool_stats().items():
+                logger.info(f"Pool {name}: {stats}")
+            logger.info(f"Bundle cache: {BundleCache.shared().stats()}")
+
+    def on_config_change(self, config, section, key, value):
+        """Apply changed settings."""
+        if section == "app" and key == "image_cache_mb":
+            self.apply_cache_budget()
+        elif section == "app" and key == "process_decode":
+            self.apply_process_decode()
+
+    def apply_cache_budget(self):
+        """Set the image cache budget from the config."""
+        value = self.config.get("app", "image_cache_mb")
+        try:
+            # The settings panel stores numbers as floats, e.g. "256.5"
+            megabytes = int(float(value))
+        except (ValueError, OverflowError):
+            logger.warning(f"Invalid image cache size {value!r}, using default")
+            megabytes = DEFAULT_CACHE_MB
+        megabytes = max(megabytes, MIN_CACHE_MB)
+        CardData.set_cache_budget(megabytes * 1024 * 1024)
+
+    def apply_process_decode(self):
+        """Decode textures in threads or worker processes from the config."""
+        enabled = self.config.getboolean("app", "process_decode")
+        CardData.set_process_decode(enabled)
+        # Keep every worker busy while the grid fills
+        scheduler = LoadScheduler.shared()
+        scheduler.max_concurrent = LoadScheduler.DEFAULT_CONCURRENT
+        if enabled:
+            scheduler.max_concurrent = max(
+                scheduler.max_concurrent, Async().pool("cpu").max_workers
+            )
+
     def build_settings(self, settings):
         """Prepare setting panels."""
         jsonpath = Path("./witchcrafted/view/settings.json")
@@ -130,8 +184,6 @@ class WitchcraftedApp(KivyApp):
 
 def main(opts):
     """Run with asyncio."""
-    colorama_init()
-
     app = WitchcraftedApp(opts)
 
     asc = Async()
@@ -143,8 +195,12 @@ def main(opts):
         asc.shutdown()
     finally:
         app.config.write()
+        BundleIndex.flush_all()
 
 
 if __name__ == "__main__":
-    opts = docopt(__doc__)
-    main(opts)
+    from witchcrafted import cli
+
+    multiprocessing.freeze_support()
+    # Run this module's GUI rather than importing it again as witchcrafted.main
+    cli.main(gui=main)
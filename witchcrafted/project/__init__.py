@@ -1,5 +1,21 @@
-"""Project related code."""
+"""
+Project related code.
 
-from . import project_view, project_data
+Submodules are imported on first access, only project_view needs Kivy.
+"""
 
-__all__ = [project_view, project_data]
+import importlib
+
+__all__ = ["project_view", "project_data"]
+
+
+def __getattr__(name):
+    """Import submodules when they are first used."""
+    if name in __all__:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    """List the submodules along with the loaded attributes."""
+    return sorted(set(globals()) | set(__all__))
@@ -1,22 +1,183 @@
 """Handles project files."""
 
 from io import BytesIO
-from zipfile import ZipFile
+from zipfile import ZipFile, ZipInfo, ZIP_STORED
 from yaml import dump, safe_load
 import re
 from PIL import Image
 import time
+import asyncio
+import collections
+from contextlib import aclosing
+import hashlib
+import os
+import shutil
+from pathlib import Path
 from packaging.version import parse as version_parse
 
-from kivy.app import App
-
 from witchcrafted.cards.card_data import CardData
-from witchcrafted.utils import sanatize_text, make_logger
+from witchcrafted.utils import Async, sanatize_text, make_logger
 
 logger = make_logger(__file__)
 
 PROJECT_VERSION = "1.0.0"
 
+CARD_IMAGE_PATTERN = re.compile(r"^cards/([0-9]+)/image.png$")
+
+# Images being encoded at once while saving, bounds the memory of a save
+ENCODE_WINDOW = 8
+
+# A project file is rewritten once entries dropped from its index take up
+# more than this share of it and at least COMPACT_MIN_BYTES
+COMPACT_RATIO = 0.5
+COMPACT_MIN_BYTES = 16 * 1024 * 1024
+
+
+def encode_png(image):
+    """Encode an image as PNG, run in a worker process."""
+    buffer = BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def image_digest(image):
+    """Hash the pixels of an image."""
+    digest = hashlib.sha1(f"{image.mode} {image.size}".encode("utf-8"))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def encode_changed(image, digest=None):
+    """
+    Hash an image and encode it as PNG unless it has a known hash.
+
+    Run this in a worker process.
+
+    :param digest: hash of the image already saved, None to always encode
+    :return: (hash, PNG bytes or None if the hash is digest)
+    """
+    new_digest = image_digest(image)
+    if new_digest == digest:
+        return (new_digest, None)
+    return (new_digest, encode_png(image))
+
+
+def decode_png(file_name, name):
+    """Read and decode an image of a project file, run in a worker process."""
+    with ZipFile(file_name, mode="r", allowZip64=True) as zip_ob:
+        png = zip_ob.read(name)
+    image = Image.open(BytesIO(png))
+    image.load()
+    return image
+
+
+def entry_size(info):
+    """Estimate the bytes an archive member takes up, headers included."""
+    return (
+        30 + len(info.filename.encode("utf-8")) + len(info.extra) + info.compress_size
+    )
+
+
+def stored_info(name, date_time, file_size=0):
+    """Describe a member stored without compression, PNG already is."""
+    info = ZipInfo(name, date_time=date_time)
+    info.compress_type = ZIP_STORED
+    info.file_size = file_size
+    return info
+
+
+def write_image(zip_ob, sources, name, png, date_time):
+    """
+    Write a PNG into an archive, copying it if a project file holds it.
+
+    :param sources: dict of file name to the archive opened for the save,
+                    so every project file is opened and indexed once
+    :param png: PNG bytes or the ProjectImage holding them
+    """
+    if not isinstance(png, ProjectImage):
+        zip_ob.writestr(stored_info(name, date_time), png)
+        return
+    source = sources.get(png.file_name, None)
+    if source is None:
+        source = ZipFile(png.file_name, mode="r", allowZip64=True)
+        sources[png.file_name] = source
+    info = stored_info(name, date_time, source.getinfo(png.name).file_size)
+    with source.open(png.name, mode="r") as fi:
+        with zip_ob.open(info, mode="w") as fo:
+            shutil.copyfileobj(fi, fo)
+
+
+def journal_path(file_name):
+    """Get the file recording a project file's size while it is appended to."""
+    return file_name.with_name(f".{file_name.name}.journal")
+
+
+def begin_append(file_name, size):
+    """Record the size of a project file before appending to it."""
+    with open(journal_path(file_name), "w", encoding="ascii") as f:
+        f.write(f"{size}")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def end_append(file_name):
+    """Make an append to a project file durable and forget its journal."""
+    with open(file_name, "r+b") as f:
+        os.fsync(f.fileno())
+    journal_path(file_name).unlink()
+
+
+def recover(file_name):
+    """
+    Undo an append to a project file that did not complete.
+
+    Appends only add bytes after the end of the file, cutting it back to
+    the size in the journal restores the file as it was.
+    """
+    journal = journal_path(file_name)
+    try:
+        size = int(journal.read_text(encoding="ascii"))
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError):
+        # Killed while writing the journal, before anything was appended
+        journal.unlink(missing_ok=True)
+        return
+    try:
+        with open(file_name, "r+b") as f:
+            if os.fstat(f.fileno()).st_size > size:
+                logger.warning(f"Undoing an unfinished save of {file_name}")
+                f.truncate(size)
+                f.flush()
+                os.fsync(f.fileno())
+    except FileNotFoundError:
+        pass
+    journal.unlink()
+
+
+class ProjectImage:
+    """An image of a project file, read and decoded only when needed."""
+
+    __slots__ = ("file_name", "name")
+
+    def __init__(self, file_name, name):
+        """Create the handle of an archive member."""
+        self.file_name = file_name
+        self.name = name
+
+    def __repr__(self):
+        """Debug print."""
+        return f"<{type(self).__name__} {self.file_name}:{self.name}>"
+
+    def read(self):
+        """Read the PNG bytes."""
+        with ZipFile(self.file_name, mode="r", allowZip64=True) as zip_ob:
+            return zip_ob.read(self.name)
+
+    def image(self):
+        """Decode the image."""
+        return decode_png(self.file_name, self.name)
+
 
 class ProjectData:
     """Project data."""
@@ -46,6 +207,14 @@ class ProjectData:
         self._name = None
         self._description = None
         self.edits = {}
+        # Card ID to (image, ProjectImage) of images that are in the project
+        # file unchanged
+        self.files = {}
+        # Card ID to the image hash of the images in the project file
+        self.hashes = {}
+        # The project file and its (mtime, size) when last loaded or saved
+        self.file_name = None
+        self._file_stat = None
 
     def __repr__(self, *args, **kwargs):
         """Debug print."""
@@ -73,40 +242,309 @@ class ProjectData:
                     self.add_card_image(card_id, image)
 
     async def apply(self):
-        """Apply project data into working editing data."""
-        for (card_id, edit) in self.edits.items():
-            card_data = CardData(card_id)
-            image = edit.get("image", None)
-            if image:
-                await card_data.set_image(image)
+        """
+        Apply project data into working editing data.
 
-    async def save(self, file_name):
-        """Save the project."""
-        zip_bytes = BytesIO()
-        await self.store()
+        Images still in the project file are decoded in worker processes,
+        a few at a time.
+        """
+        asc = Async()
+        window = asyncio.Semaphore(ENCODE_WINDOW)
+
+        async def apply_edit(card_id, image):
+            if isinstance(image, ProjectImage):
+                handle = image
+                async with window:
+                    image = await asc.async_process(
+                        decode_png, handle.file_name, handle.name
+                    )
+                self.files[card_id] = (image, handle)
+            await CardData(card_id).set_image(image)
+
+        await asyncio.gather(
+            *(
+                apply_edit(card_id, edit["image"])
+                for (card_id, edit) in self.edits.items()
+                if edit.get("image", None)
+            )
+        )
+
+    def _saved_handle(self, card_id, image):
+        """Get the handle of an image that is in the project file as it is."""
+        if isinstance(image, ProjectImage):
+            return image
+        (saved, handle) = self.files.get(card_id, (None, None))
+        if saved is image:
+            return handle
+        return None
+
+    async def prepared_images(self, in_place):
+        """
+        Get the hashes and PNG files of the edited images, in edit order.
+
+        Images are hashed and encoded in worker processes, a few at a time.
+        Images a project file already holds are not encoded again.
+
+        :param in_place: saving to the project file as last loaded or
+                         saved, images with the hash it lists for them are
+                         the ones it holds
+        :return: async iterator of (card_id, image, hash, PNG bytes or the
+                 ProjectImage holding them)
+        """
+        asc = Async()
+        pending = collections.deque()
 
-        meta = {
+        async def held(digest, handle):
+            return (digest, handle)
+
+        async def encoded(card_id, image, digest):
+            (digest, png) = await asc.async_process(encode_changed, image, digest)
+            if png is None:
+                png = ProjectImage(self.file_name, f"cards/{card_id}/image.png")
+            return (digest, png)
+
+        try:
+            for (card_id, edit) in self.edits.items():
+                image = edit.get("image", None)
+                if not image:
+                    continue
+                handle = self._saved_handle(card_id, image)
+                if handle is not None:
+                    prepared = held(self.hashes.get(card_id, None), handle)
+                else:
+                    digest = self.hashes.get(card_id, None) if in_place else None
+                    prepared = encoded(card_id, image, digest)
+                pending.append((card_id, image, asyncio.ensure_future(prepared)))
+                if len(pending) >= ENCODE_WINDOW:
+                    (card_id, image, prepared) = pending.popleft()
+                    yield (card_id, image, *await prepared)
+            while pending:
+                (card_id, image, prepared) = pending.popleft()
+                yield (card_id, image, *await prepared)
+        finally:
+            for (_, _, prepared) in pending:
+                prepared.cancel()
+
+    def meta(self, hashes=None):
+        """
+        Get the contents of meta.yml.
+
+        :param hashes: image hashes to list instead of the saved ones
+        """
+        if hashes is None:
+            hashes = self.hashes
+        return {
             "name": self.name,
             "description": self.description,
             "version": PROJECT_VERSION,
+            "images": {
+                card_id: hashes[card_id]
+                for card_id in self.edits
+                if hashes.get(card_id, None)
+            },
         }
 
-        with ZipFile(zip_bytes, mode="w", allowZip64=True) as zip_ob:
-            zip_ob.writestr("meta.yml", dump(meta, default_flow_style=False))
+    def _file_changed(self, file_name):
+        """Check if a file is not the project file as it was last seen."""
+        if self.file_name is None or self._file_stat is None:
+            return True
+        try:
+            if not os.path.samefile(self.file_name, file_name):
+                return True
+            stat = os.stat(file_name)
+        except OSError:
+            return True
+        return (stat.st_mtime_ns, stat.st_size) != self._file_stat
 
-            for (card_id, edit) in self.edits.items():
-                image = edit.get("image", None)
-                if image:
-                    with zip_ob.open(f"cards/{card_id}/image.png", mode="w") as fo:
-                        image.save(fo, "PNG")
+    def _saved(self, file_name, written):
+        """
+        Remember what is in the project file after a save.
+
+        :param written: dict of card ID to the image written
+        """
+        stat = os.stat(file_name)
+        self.file_name = file_name
+        self._file_stat = (stat.st_mtime_ns, stat.st_size)
+        for (card_id, edit) in self.edits.items():
+            image = edit.get("image", None)
+            handle = ProjectImage(file_name, f"cards/{card_id}/image.png")
+            if isinstance(image, ProjectImage):
+                edit["image"] = handle
+            elif image is not None and (
+                written.get(card_id, None) is image
+                or self._saved_handle(card_id, image) is not None
+            ):
+                self.files[card_id] = (image, handle)
+
+    async def save(self, file_name):
+        """
+        Save the project.
+
+        Saving to the file the project was loaded from or last saved to
+        only appends the images that changed since and writes nothing if
+        neither they nor the metadata did. Other saves write the whole file.
+        """
+        await self.store()
+        file_name = Path(file_name)
+        await Async().async_thread(lambda: recover(file_name))
+        if self._file_changed(file_name):
+            await self.save_full(file_name)
+        else:
+            await self.save_incremental(file_name)
+
+    async def save_incremental(self, file_name):
+        """
+        Append the changed images to the project file.
+
+        Members are only added after the end of the file and the new index
+        lists the unchanged ones where they are, so the bytes of the
+        previous archive are never touched. Until the append is complete a
+        journal records the previous size of the file, a save that fails or
+        is killed is undone by cutting the file back to it. The file is
+        rewritten once replaced members take up too much of it.
+        """
+        asc = Async()
+        date_time = time.localtime()[:6]
+        zip_ob = await asc.async_thread(
+            lambda: ZipFile(file_name, mode="a", allowZip64=True)
+        )
+        size = os.fstat(zip_ob.fp.fileno()).st_size
+        # Write after the previous end record instead of over the index
+        zip_ob.start_dir = size
+        appending = False
+        sources = {}
+        written = {}
+        hashes = {}
+
+        def replace(name, write=None):
+            nonlocal appending
+            if not appending:
+                begin_append(file_name, size)
+                appending = True
+            old = zip_ob.NameToInfo.pop(name, None)
+            if old is not None:
+                zip_ob.filelist.remove(old)
+            if write is not None:
+                write()
 
-        with open(file_name, "wb") as outfile:
-            outfile.write(zip_bytes.getbuffer())
+        def finish(meta):
+            names = {f"cards/{card_id}/image.png" for card_id in written}
+            for info in list(zip_ob.filelist):
+                match = CARD_IMAGE_PATTERN.match(info.filename)
+                if match and info.filename not in names:
+                    # The card is no longer edited
+                    replace(info.filename)
+            if (
+                appending
+                or zip_ob.NameToInfo.get("meta.yml", None) is None
+                or (zip_ob.read("meta.yml") != meta)
+            ):
+                replace("meta.yml", lambda: zip_ob.writestr("meta.yml", meta))
+            live = sum(map(entry_size, zip_ob.infolist()))
+            dead = zip_ob.start_dir - live
+            zip_ob.close()
+            if appending:
+                end_append(file_name)
+            return dead > max(COMPACT_RATIO * live, COMPACT_MIN_BYTES)
+
+        try:
+            async with aclosing(self.prepared_images(in_place=True)) as images:
+                async for (card_id, image, digest, png) in images:
+                    name = f"cards/{card_id}/image.png"
+                    hashes[card_id] = digest
+                    written[card_id] = image
+                    if isinstance(png, ProjectImage) and (
+                        (png.file_name, png.name) == (file_name, name)
+                    ):
+                        # Already in the file where the index lists it
+                        continue
+                    await asc.async_thread(
+                        lambda: replace(
+                            name,
+                            lambda: write_image(zip_ob, sources, name, png, date_time),
+                        )
+                    )
+            meta = dump(self.meta(hashes), default_flow_style=False).encode("utf-8")
+            bloated = await asc.async_thread(lambda: finish(meta))
+        except BaseException:
+            try:
+                zip_ob.close()
+            finally:
+                if appending:
+                    recover(file_name)
+            raise
+        finally:
+            for source in sources.values():
+                source.close()
+        self.hashes = hashes
+        self._saved(file_name, written)
+        if bloated:
+            logger.info(f"Compacting {file_name}")
+            await self.save_full(file_name, in_place=True)
+
+    async def save_full(self, file_name, in_place=False):
+        """
+        Write the whole project file.
+
+        The archive is streamed to a temporary file next to the target and
+        renamed over it once complete, so a failed save leaves the previous
+        file intact. Images a project file holds are copied from it as they
+        are, every such file is opened once.
+
+        :param in_place: file_name is the project file as last loaded or
+                         saved
+        """
+        asc = Async()
+        tmp_name = file_name.with_name(f".{file_name.name}.{os.getpid()}.tmp")
+        date_time = time.localtime()[:6]
+        zip_ob = await asc.async_thread(
+            lambda: ZipFile(tmp_name, mode="w", allowZip64=True)
+        )
+        sources = {}
+        written = {}
+        hashes = {}
+
+        try:
+            async with aclosing(self.prepared_images(in_place)) as images:
+                async for (card_id, image, digest, png) in images:
+                    name = f"cards/{card_id}/image.png"
+                    hashes[card_id] = digest
+                    written[card_id] = image
+                    await asc.async_thread(
+                        lambda: write_image(zip_ob, sources, name, png, date_time)
+                    )
+            meta = dump(self.meta(hashes), default_flow_style=False).encode("utf-8")
+            zip_ob.writestr("meta.yml", meta)
+            await asc.async_thread(zip_ob.close)
+            os.replace(tmp_name, file_name)
+        except BaseException:
+            try:
+                zip_ob.close()
+            finally:
+                tmp_name.unlink(missing_ok=True)
+            raise
+        finally:
+            for source in sources.values():
+                source.close()
+        self.hashes = hashes
+        self._saved(file_name, written)
 
     @classmethod
     async def load(cls, file_name):
-        """Load a project (dosen't apply the edits)."""
+        """
+        Load a project (dosen't apply the edits).
+
+        Only the metadata and the archive index are read, images stay in
+        the file until they are applied.
+        """
+        return await Async().async_thread(lambda: cls.read_index(file_name))
+
+    @classmethod
+    def read_index(cls, file_name):
+        """Read the metadata and the images listed in a project file."""
         output = cls()
+        file_name = Path(file_name)
+        recover(file_name)
         with ZipFile(file_name, mode="r", allowZip64=True) as zip_ob:
             namelist = zip_ob.namelist()
             version = None
@@ -116,6 +554,7 @@ class ProjectData:
                     version = meta.get("version", None)
                     output.name = meta.get("name", "")
                     output.description = meta.get("description", "")
+                    hashes = meta.get("images", None) or {}
             if not version:
                 logger.warn("Project version missing")
                 return
@@ -124,26 +563,22 @@ class ProjectData:
             if file_version > max_version:
                 logger.warn("Project version unsupported")
                 return None
-            card_images = [
-                int(re.match(r"^cards/([0-9]+)/image.png$", c).group(1))
-                for c in namelist
-                if re.match(r"^cards/[0-9]+/image.png$", c)
-            ]
-            for card_id in card_images:
-                with zip_ob.open(f"cards/{card_id}/image.png", mode="r") as fo:
+            for name in namelist:
+                match = CARD_IMAGE_PATTERN.match(name)
+                if match:
+                    card_id = int(match.group(1))
                     if card_id not in output.edits:
                         output.edits[card_id] = {}
-                    image = Image.open(fo)
-                    image.load()
-                    output.edits[card_id]["image"] = image
-        app = App.get_running_app()
-        app.root.card_view.reset_panels()
+                    output.edits[card_id]["image"] = ProjectImage(file_name, name)
+                    if hashes.get(card_id, None):
+                        output.hashes[card_id] = hashes[card_id]
+        stat = file_name.stat()
+        output.file_name = file_name
+        output._file_stat = (stat.st_mtime_ns, stat.st_size)
         return output
 
     async def commit(self):
         """Commit changes to disk."""
-        for card_id in CardData.edited_card():
-            card_data = CardData(card_id)
-            stamp = time.strftime("%Y-%m-%d_%H%M", time.localtime())
-            name = self.name if self.name else "Navnlos"
-            await card_data.commit(sanatize_text(f"{name}_{stamp}"))
+        stamp = time.strftime("%Y-%m-%d_%H%M", time.localtime())
+        name = self.name if self.name else "Navnlos"
+        await CardData.commit_all(sanatize_text(f"{name}_{stamp}"))
@@ -7,7 +7,8 @@ from kivy.app import App
 from witchcrafted.project.project_data import ProjectData
 from witchcrafted.utils import Async
 from witchcrafted.cards.card_data import CardData
-from witchcrafted.dialogs import LoadDialog, SaveDialog
+from witchcrafted.cards.bulk_import import bulk_import
+from witchcrafted.dialogs import LoadDialog, SaveDialog, ProgressDialog
 
 
 class ProjectView(GridLayout):
@@ -49,6 +50,7 @@ class ProjectView(GridLayout):
             file_path = file_paths[0]
             project = await ProjectData.load(file_path)
             if project:
+                app.root.card_view.reset_panels()
                 self.project = project
                 CardData.forget_all()
                 if self.name_input:
@@ -75,3 +77,34 @@ class ProjectView(GridLayout):
         """Apply all edits to game files."""
         await self.project.store()
         await self.project.commit()
+
+    def import_folder(self):
+        """Replace card art with the images of a folder."""
+        Async().async_fire(self.async_import(open_directory=True))
+
+    def import_zip(self):
+        """Replace card art with the images of a zip."""
+        Async().async_fire(self.async_import(open_directory=False))
+
+    async def async_import(self, open_directory):
+        """Replace card art with images named by card ID."""
+        app = App.get_running_app()
+        start_path = app.config.get("paths", "output")
+        file_paths = await LoadDialog.show(
+            open_directory=open_directory,
+            extensions=[] if open_directory else [".zip"],
+            start_path=start_path,
+        )
+        if not file_paths:
+            return
+        source = file_paths[0]
+        dialog = ProgressDialog.show("Import", text=f"Importing {source.name}")
+        try:
+            await bulk_import(
+                source,
+                progress=dialog.update,
+                cancelled=lambda: dialog.cancelled,
+            )
+        finally:
+            dialog.dismiss()
+            app.root.card_view.reset_panels()
@@ -3,11 +3,17 @@
 from random import choice
 import asyncio
 import concurrent.futures
+import multiprocessing
 import colorlog
 from colorlog import ColoredFormatter
 from pathlib import Path
 import traceback
+import threading
 import sys
+import os
+import json
+import re
+import time
 
 try:
     import winreg
@@ -83,152 +89,212 @@ def sanatize_text(text):
     return text.translate(sanatize_map)
 
 
-def get_steam_paths():
-    """Find a steam path with masterduel."""
-    steam_paths = []
-    # ==== WINDOWS ====
-    # Check for steam via windows registery
-    if winreg is not None:
+STEAM_SUBDIRS = [
+    ("drive_c", "Program Files (x86)", "Steam"),
+    ("drive_c", "Program Files", "Steam"),
+]
+MD_SUBDIR = ("steamapps", "common", "Yu-Gi-Oh!  Master Duel")
+
+# How long not finding the game is trusted before scanning again, in seconds
+NOT_FOUND_TTL = 24 * 60 * 60
+
+INSTALL_CACHE_VERSION = 1
+
+
+def _registry_steam_paths():
+    """Get the steam install from the windows registery."""
+    if winreg is None:
+        return []
+    try:
+        hkey = winreg.OpenKey(
+            winreg.HKEY_LOCAL_MACHINE, r"SOFTWARE\WOW6432Node\Valve\Steam"
+        )
+    except Exception:
+        hkey = None
+    if not hkey:
         try:
             hkey = winreg.OpenKey(
-                winreg.HKEY_LOCAL_MACHINE, r"SOFTWARE\WOW6432Node\Valve\Steam"
+                winreg.HKEY_LOCAL_MACHINE,
+                r"SOFTWARE\Valve.PlayOnLinux/wineprefix/PrefixName\Steam",
             )
         except Exception:
             hkey = None
-        if not hkey:
-            try:
-                hkey = winreg.OpenKey(
-                    winreg.HKEY_LOCAL_MACHINE,
-                    r"SOFTWARE\Valve.PlayOnLinux/wineprefix/PrefixName\Steam",
-                )
-            except Exception:
-                hkey = None
-        if hkey:
-            try:
-                steam_path = winreg.QueryValueEx(hkey, "InstallPath")
-            except Exception:
-                steam_path = None
-            if steam_path:
-                steam_path = Path(steam_path)
-                if steam_path.exists():
-                    logger.info(f"Steam found at: {steam_path}")
-                    steam_paths.append(steam_path)
-    # ==== LINUX ====
+    if hkey:
+        try:
+            (steam_path, _) = winreg.QueryValueEx(hkey, "InstallPath")
+        except Exception:
+            steam_path = None
+        if steam_path:
+            return [Path(steam_path)]
+    return []
+
+
+def _prefix_containers():
+    """
+    Get the directories whose children may hold a steam install.
+
+    :return: list of (directory, path of the wine prefix within a child)
+    """
     home = Path.home()
-    # Check for playonlinux
-    with home.joinpath(".PlayOnLinux", "wineprefix") as playonlinux:
-        if playonlinux.exists():
-            logger.info("Play on linux found")
-            for prefix in playonlinux.iterdir():
-                steam_path = prefix.joinpath("drive_c", "Program Files (x86)", "Steam")
-                if steam_path.exists():
-                    logger.info(f"Steam found at: {steam_path}")
-                    steam_paths.append(steam_path)
-                steam_path = prefix.joinpath("drive_c", "Program Files", "Steam")
-                if steam_path.exists():
-                    logger.info(f"Steam found at: {steam_path}")
-                    steam_paths.append(steam_path)
-
-    with home.joinpath(".local", "share", "bottles", "bottles") as bottles:
-        if bottles.exists():
-            logger.info("Bottles found")
-            for prefix in bottles.iterdir():
-                steam_path = prefix.joinpath("drive_c", "Program Files (x86)", "Steam")
-                if steam_path.exists():
-                    logger.info(f"Steam found at: {steam_path}")
-                    steam_paths.append(steam_path)
-                steam_path = prefix.joinpath("drive_c", "Program Files", "Steam")
-                if steam_path.exists():
-                    logger.info(f"Steam found at: {steam_path}")
-                    steam_paths.append(steam_path)
-
-    # ==== MACOS ====
-    # Playonmac
-    with home.joinpath("Library", "PlayOnMac", "wineprefix") as playonmac:
-        if playonmac.exists():
-            logger.info("Play on mac found")
-            for prefix in playonmac.iterdir():
-                steam_path = prefix.joinpath("drive_c", "Program Files (x86)", "Steam")
-                if steam_path.exists():
-                    logger.info(f"Steam found at: {steam_path}")
-                    steam_paths.append(steam_path)
-                steam_path = prefix.joinpath("drive_c", "Program Files", "Steam")
-                if steam_path.exists():
-                    logger.info(f"Steam found at: {steam_path}")
-                    steam_paths.append(steam_path)
-    # Check for  wineskin apps that contain steam (macos)
     root = Path(home.root)
-    with root.joinpath("Applications") as applications_root:
-        if applications_root.exists():
-            for app in applications_root.iterdir():
-                steam_path = app.joinpath(
-                    "Contents", "Resources", "drive_c", "Program Files (x86)", "Steam"
-                )
-                if steam_path.exists():
-                    logger.info(f"Steam found at: {steam_path}")
-                    steam_paths.append(steam_path)
-                steam_path = app.joinpath(
-                    "Contents", "Resources", "drive_c", "Program Files", "Steam"
-                )
-                if steam_path.exists():
-                    logger.info(f"Steam found at: {steam_path}")
-                    steam_paths.append(steam_path)
-    with home.joinpath("Applications") as applications_home:
-        if applications_home.exists():
-            for app in applications_home.iterdir():
-                steam_path = app.joinpath(
-                    "Contents", "Resources", "drive_c", "Program Files (x86)", "Steam"
-                )
-                if steam_path.exists():
-                    logger.info(f"Steam found at: {steam_path}")
-                    steam_paths.append(steam_path)
-                steam_path = app.joinpath(
-                    "Contents", "Resources", "drive_c", "Program Files", "Steam"
-                )
-                if steam_path.exists():
-                    logger.info(f"Steam found at: {steam_path}")
-                    steam_paths.append(steam_path)
-
-    # ### LINUX/MACOS ######
-    # Check for wine
-    with home.joinpath(".wine") as wine_path:
-        if wine_path.exists():
-            logger.info("Wine found")
-            steam_path = wine_path.joinpath("drive_c", "Program Files (x86)", "Steam")
-            if steam_path.exists():
-                logger.info(f"Steam found at: {steam_path}")
-                steam_paths.append(steam_path)
-            steam_path = wine_path.joinpath("drive_c", "Program Files", "Steam")
-            if steam_path.exists():
-                logger.info(f"Steam found at: {steam_path}")
-                steam_paths.append(steam_path)
-    # Check for wine64
-    with home.joinpath(".wine64") as wine64_path:
-        if wine_path.exists():
-            logger.info("Wine64 found")
-            steam_path = wine64_path.joinpath("drive_c", "Program Files (x86)", "Steam")
-            if steam_path.exists():
-                logger.info(f"Steam found at: {steam_path}")
-                steam_paths.append(steam_path)
-            steam_path = wine64_path.joinpath("drive_c", "Program Files", "Steam")
-            if steam_path.exists():
-                logger.info(f"Steam found at: {steam_path}")
-                steam_paths.append(steam_path)
-    return steam_paths
+    return [
+        # ==== LINUX ====
+        (home.joinpath(".PlayOnLinux", "wineprefix"), ()),
+        (home.joinpath(".local", "share", "bottles", "bottles"), ()),
+        # ==== MACOS ====
+        (home.joinpath("Library", "PlayOnMac", "wineprefix"), ()),
+        # Wineskin apps that contain steam
+        (root.joinpath("Applications"), ("Contents", "Resources")),
+        (home.joinpath("Applications"), ("Contents", "Resources")),
+    ]
+
+
+def _wine_prefixes():
+    """Get the default wine prefixes (linux/macos)."""
+    home = Path.home()
+    return [home.joinpath(".wine"), home.joinpath(".wine64")]
+
+
+def _list_prefixes(container, inner):
+    """List the wine prefixes of a container, empty if it doesn't exist."""
+    try:
+        return [child.joinpath(*inner) for child in container.iterdir()]
+    except OSError:
+        return []
+
+
+def _steam_candidates(executor):
+    """Get every path a steam install may be at, in order of preference."""
+    containers = _prefix_containers()
+    listings = executor.map(lambda c: _list_prefixes(*c), containers)
+    candidates = list(_registry_steam_paths())
+    for prefixes in listings:
+        for prefix in prefixes:
+            candidates.extend(prefix.joinpath(*sub) for sub in STEAM_SUBDIRS)
+    for prefix in _wine_prefixes():
+        candidates.extend(prefix.joinpath(*sub) for sub in STEAM_SUBDIRS)
+    return candidates
+
 
+def _probe(paths, executor):
+    """Get the paths that are directories, probed concurrently."""
+    found = executor.map(lambda path: path.is_dir(), paths)
+    return [path for (path, is_dir) in zip(paths, found) if is_dir]
 
-def get_md_paths():
-    """Get all masterduel path directories."""
-    md_paths = []
-    steam_paths = get_steam_paths()
+
+def get_steam_paths():
+    """Find a steam path with masterduel."""
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=16, thread_name_prefix="discovery"
+    ) as executor:
+        steam_paths = _probe(_steam_candidates(executor), executor)
     for steam_path in steam_paths:
-        md_path = steam_path.joinpath("steamapps", "common", "Yu-Gi-Oh!  Master Duel")
-        if md_path.exists():
-            logger.info(f"Masterduel found at {md_path}")
-            md_paths.append(md_path)
+        logger.info(f"Steam found at: {steam_path}")
+    return steam_paths
+
+
+def _install_cache_path():
+    """Get where discovered install paths are kept."""
+    return cache_dir().joinpath("install_paths.json")
+
+
+def _load_install_cache():
+    """Read the discovered install paths, None if unusable."""
+    try:
+        cache = json.loads(_install_cache_path().read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cache, dict) or cache.get("version") != INSTALL_CACHE_VERSION:
+        return None
+    return cache
+
+
+def _save_install_cache(cache):
+    """Write the discovered install paths."""
+    cache["version"] = INSTALL_CACHE_VERSION
+    path = _install_cache_path()
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        tmp_path.write_text(json.dumps(cache, indent=1), encoding="utf-8")
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Failed to save install paths: {e}")
+
+
+def _cached_md_paths(cache):
+    """
+    Get the cached masterduel paths if they are still valid.
+
+    Only the cached paths themselves are checked. A cached miss is trusted
+    for NOT_FOUND_TTL.
+    """
+    if cache is None or "md_paths" not in cache:
+        return None
+    md_paths = [Path(md_path) for md_path in cache["md_paths"]]
+    if not md_paths:
+        if time.time() - cache.get("scanned", 0) < NOT_FOUND_TTL:
+            return md_paths
+        return None
+    if all(md_path.is_dir() for md_path in md_paths):
+        return md_paths
+    return None
+
+
+def get_md_paths(rescan=False):
+    """
+    Get all masterduel path directories.
+
+    The result of the last scan is reused while the paths still exist.
+
+    :param rescan: ignore the cached result
+    """
+    cache = _load_install_cache() or {}
+    md_paths = None if rescan else _cached_md_paths(cache)
+    if md_paths is not None:
+        return md_paths
+
+    md_candidates = [
+        steam_path.joinpath(*MD_SUBDIR) for steam_path in get_steam_paths()
+    ]
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=8, thread_name_prefix="discovery"
+    ) as executor:
+        md_paths = _probe(md_candidates, executor)
+    for md_path in md_paths:
+        logger.info(f"Masterduel found at {md_path}")
+    cache["md_paths"] = [f"{md_path}" for md_path in md_paths]
+    cache["scanned"] = time.time()
+    _save_install_cache(cache)
     return md_paths
 
 
+def get_md_profile(md_path):
+    """
+    Get the profile directory in masterduel's LocalData.
+
+    The profile found last time is reused while it still exists.
+
+    :return: the profile directory or None if there is none
+    """
+    cache = _load_install_cache() or {}
+    profiles = cache.setdefault("profiles", {})
+    profile_dir = profiles.get(f"{md_path}", None)
+    if profile_dir is not None and Path(profile_dir).is_dir():
+        return Path(profile_dir)
+
+    profile_dir = None
+    try:
+        for profile in md_path.joinpath("LocalData").iterdir():
+            if profile.name != "00000000" and re.match(r"^[0-9a-f]+$", profile.name):
+                profile_dir = profile
+    except OSError:
+        return None
+    if profile_dir is not None:
+        profiles[f"{md_path}"] = f"{profile_dir}"
+        _save_install_cache(cache)
+    return profile_dir
+
+
 def data_dir():
     """Get the TLD of the data."""
     if getattr(sys, "frozen", False) and hasattr(sys, "_MEIPASS"):
@@ -240,21 +306,208 @@ def data_dir():
     return tld
 
 
+def cache_dir():
+    """Get the directory used for persistent caches."""
+    home = Path.home()
+    if sys.platform.startswith("win"):
+        base = Path(os.environ.get("LOCALAPPDATA", home / "AppData" / "Local"))
+    elif sys.platform == "darwin":
+        base = home / "Library" / "Caches"
+    else:
+        base = Path(os.environ.get("XDG_CACHE_HOME", home / ".cache"))
+    path = base / "witchcrafted"
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+class LoopWatchdog:
+    """
+    Report when something blocks the event loop.
+
+    The loop bumps a heartbeat every interval. A watchdog thread logs the
+    stack of the loop's thread while a beat is overdue by more than the
+    threshold, and the loop logs how long it was blocked once it catches
+    up.
+    """
+
+    def __init__(self, loop, threshold=0.1, interval=0.05):
+        """
+        Create the watchdog.
+
+        :param threshold: blocking time to report, in seconds
+        :param interval: time between heartbeats, in seconds
+        """
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self._last_beat = time.monotonic()
+        self._reported = None
+        self._loop_thread = None
+        self._handle = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start watching, must be called from the loop's thread."""
+        self._loop_thread = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._handle = self.loop.call_later(self.interval, self._beat)
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        """Stop watching."""
+        self._stopped.set()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _beat(self):
+        """Record the loop is running, on the loop."""
+        now = time.monotonic()
+        blocked = now - self._last_beat - self.interval
+        if blocked > self.threshold:
+            logger.warning(f"Event loop was blocked for {blocked * 1000:.0f} ms")
+        self._last_beat = now
+        if not self._stopped.is_set():
+            self._handle = self.loop.call_later(self.interval, self._beat)
+
+    def _watch(self):
+        """Log the loop's stack when a beat is overdue, on the watchdog thread."""
+        while not self._stopped.wait(self.threshold / 2):
+            last_beat = self._last_beat
+            blocked = time.monotonic() - last_beat - self.interval
+            if blocked <= self.threshold or self._reported == last_beat:
+                continue
+            self._reported = last_beat
+            frame = sys._current_frames().get(self._loop_thread, None)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame))
+            logger.warning(
+                f"Event loop blocked for over {blocked * 1000:.0f} ms in:\n{stack}"
+            )
+
+
+class ExecutorPool:
+    """
+    A named executor started on first use.
+
+    Keeps how many tasks are in flight and how long they take from submit
+    to result so a slow or backed up pool can be spotted.
+    """
+
+    def __init__(self, name, factory, max_workers):
+        """
+        Create the pool, the executor is made on first submit.
+
+        :param factory: called with max_workers to make the executor
+        """
+        self.name = name
+        self.factory = factory
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def executor(self):
+        """Get the executor, starting it if needed."""
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = self.factory(self.max_workers)
+        return self._executor
+
+    def submit(self, task, *args):
+        """Submit a task, returns a concurrent future."""
+        handle = self.executor().submit(task, *args)
+        start = time.monotonic()
+        with self._lock:
+            self.in_flight += 1
+            self.submitted += 1
+        handle.add_done_callback(lambda handle: self._finished(handle, start))
+        return handle
+
+    def _finished(self, handle, start):
+        """Record a finished task."""
+        latency = time.monotonic() - start
+        with self._lock:
+            self.in_flight -= 1
+            if handle.cancelled():
+                return
+            self.completed += 1
+            if handle.exception() is not None:
+                self.failed += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def stats(self):
+        """Get the queue depth and latency of the pool."""
+        with self._lock:
+            completed = self.completed
+            return {
+                "workers": self.max_workers,
+                "in_flight": self.in_flight,
+                "queued": max(0, self.in_flight - self.max_workers),
+                "submitted": self.submitted,
+                "completed": completed,
+                "failed": self.failed,
+                "mean_latency": self.total_latency / completed if completed else 0.0,
+                "max_latency": self.max_latency,
+            }
+
+    def shutdown(self, wait=True):
+        """Stop the executor, cancelling queued tasks."""
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def thread_pool(max_workers):
+    """Make a thread pool executor."""
+    return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+
+def process_pool(max_workers, initializer=None):
+    """
+    Make a process pool executor.
+
+    Workers are spawned, a fork of the GUI would inherit locks held by its
+    other threads and its SDL and GL state.
+    """
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=initializer,
+    )
+
+
 class Async(object):
-    """Object to handle asyncio and threadpool threads."""
+    """Object to handle asyncio and the thread and process pools."""
 
     __instance = None
 
     def __new__(cls):
-        """Create the singleton."""
+        """Create the singleton, on first use."""
         if cls.__instance is None:
-            cls.__instance = object.__new__(cls)
-
-        cls.__instance.async_tasks = []
-        cls.__instance.thread_tasks = []
-        cls.__instance.loop = asyncio.get_event_loop()
-        cls.__instance.excecutor = concurrent.futures.ThreadPoolExecutor(max_workers=5)
-        cls.__instance.loop.set_exception_handler(cls.__instance.handle_exception)
+            instance = object.__new__(cls)
+            instance.async_tasks = set()
+            instance.thread_tasks = set()
+            instance.loop = asyncio.get_event_loop()
+            instance.loop.set_exception_handler(instance.handle_exception)
+            cpus = os.cpu_count() or 1
+            instance.pools = {
+                # Mostly waiting on the disk, Python's default sizing
+                "io": ExecutorPool("io", thread_pool, min(32, cpus + 4)),
+                # UnityPy decoding, hashing and PNG encoding hold the GIL
+                "cpu": ExecutorPool("cpu", process_pool, cpus),
+            }
+            cls.__instance = instance
         return cls.__instance
 
     def handle_exception(self, loop, context):
@@ -284,21 +537,62 @@ class Async(object):
         """Run an asyncio task."""
         handle = self.async_fire(task)
         if handle is not None:
-            self.async_tasks.append(handle)
+            self.async_tasks.add(handle)
+            handle.add_done_callback(self.async_tasks.discard)
         return handle
 
+    def add_pool(self, name, factory, max_workers):
+        """
+        Add a named pool, replacing any pool of that name.
+
+        :param factory: called with max_workers to make the executor
+        """
+        old = self.pools.get(name, None)
+        self.pools[name] = ExecutorPool(name, factory, max_workers)
+        if old is not None:
+            old.shutdown(wait=False)
+        return self.pools[name]
+
+    def pool(self, name):
+        """Get a named pool."""
+        return self.pools[name]
+
+    def pool_stats(self):
+        """Get the queue depth and latency of every pool."""
+        return {name: pool.stats() for (name, pool) in self.pools.items()}
+
+    async def async_pool(self, name, task, *args):
+        """
+        Run a function on a named pool and async await its result.
+
+        Cancelling the caller cancels the task if it has not started.
+        """
+        return await asyncio.wrap_future(self.pool(name).submit(task, *args))
+
     async def async_thread(self, task):
-        """Run an thread and async await its completion."""
-        task = self.thread_task(task)
-        while not task.done():
-            await asyncio.sleep(0.01)
+        """
+        Run an thread and async await its completion.
 
+        :return: the result of the task or None if the pool cancelled it
+        """
+        handle = self.thread_task(task)
+        future = asyncio.wrap_future(handle)
         try:
-            return task.result()
-        except concurrent.futures.CancelledError:
+            await asyncio.wait([future])
+        except asyncio.CancelledError:
+            handle.cancel()
+            raise
+        if future.cancelled():
             return None
-        except Exception as e:
-            raise e
+        return future.result()
+
+    async def async_process(self, task, *args):
+        """
+        Run a function in a worker process and async await its result.
+
+        The function and its arguments must be picklable.
+        """
+        return await self.async_pool("cpu", task, *args)
 
     def async_future(self):
         """Create an async future."""
@@ -310,15 +604,13 @@ class Async(object):
 
     def thread_fire(self, task):
         """Run an thread task on the pool but don't handle a handle to it."""
-        if self.excecutor is not None:
-            handle = self.excecutor.submit(task)
-        return handle
+        return self.pool("io").submit(task)
 
     def thread_task(self, task):
         """Run an thread task on the pool."""
         handle = self.thread_fire(task)
-        if handle is not None:
-            self.thread_tasks.append(handle)
+        self.thread_tasks.add(handle)
+        handle.add_done_callback(self.thread_tasks.discard)
         return handle
 
     def shutdown(self):
@@ -329,22 +621,20 @@ class Async(object):
         """Shutdown the async and threadpool."""
         if self.loop is not None:
             # Cancel asyncio
-            for task in self.async_tasks:
+            tasks = list(self.async_tasks)
+            for task in tasks:
                 task.cancel()
             # Await clean exit
-            interval = 0.01
-            while any(map(lambda x: not x.done(), self.async_tasks)):
-                await asyncio.sleep(interval)
+            if tasks:
+                await asyncio.wait(tasks)
             self.loop.stop()
             self.loop = None
 
-        if self.excecutor is not None:
-            # Cancel all thread pools
-            for task in self.thread_tasks:
-                task.cancel()
-
-            self.excecutor.shutdown(wait=True, cancel_futures=True)
-            self.excecutor = None
+        # Cancel all thread pools
+        for task in list(self.thread_tasks):
+            task.cancel()
+        for pool in self.pools.values():
+            pool.shutdown(wait=True)
 
     def run(self):
         """Run the loop."""